@@ -1,26 +1,44 @@
 import sys
+import os
 import logging
 from argparse import ArgumentParser
 from argparse import FileType
 
-from zwbrlib.controller import Controller
-from zwbrlib.controllerdetails import ControllerDetails
-from zwbrlib.nodelist import NodeList
-from zwbrlib.backup import ZwBackup
-from zwbrlib.restore import ZwRestoration
+# The modules of zwbrlib are imported when needed, to keep the startup fast
 
 if sys.version_info < (3, 6):
     print("Invalid python version, version 3.6 or upper is required")
     sys.exit(1)
 
 p = ArgumentParser(description="Z-Wave controller NVM backup and restore")
-p.add_argument(dest="device", help="device of the Z-Wave controller (like COM4 for Windows or /dev/ttyACM0 for Linux)")
+p.add_argument(dest="devices", metavar="device", nargs='*', help="device of the Z-Wave controller (like COM4 for Windows or /dev/ttyACM0 for Linux); several devices or a pattern (like '/dev/serial/by-id/*') back up the controllers in parallel into the directory given by -b")
 p.add_argument('-v', '--verbose', dest="verbose", action='store_true', help="enable verbose mode")
 p.add_argument('-n', '--nodes', dest="nodes", action='store_true', help="display nodes")
-p.add_argument('-a', '--scan-all-nodes', dest="full_scan", action='store_true', help="try all the node ids (slower)")
+p.add_argument('-a', '--scan-all-nodes', dest="full_scan", action='store_true', help="try all the node ids (fast scan, failed ids retried)")
 p.add_argument('-s', '--soft-reset', dest="soft_reset", action='store_true', help="performes a soft reset of the controller")
 p.add_argument('-b', '--backup-file', dest="backup_dest", metavar="dest-file", help="backup the controller in the destination file")
 p.add_argument('-r', '--restore-file', dest="restore_source", metavar="source-file", type=FileType('rb'), help="restore the controller from the source file")
+p.add_argument('-d', '--differential', dest="differential", action='store_true', help="restore only the blocks that differ and verify them (no reset of the controller)")
+p.add_argument('--block-size', dest="block_size", metavar="size", type=int, help="size of the NVM transfers (negotiated with the controller by default)")
+p.add_argument('-j', '--jobs', dest="jobs", metavar="count", type=int, help="number of controllers backed up in parallel")
+p.add_argument('--manufacturers', dest="manufacturers", metavar="csv-file", help="list of the manufacturers (columns ID and Manufacturer) replacing the bundled one")
+p.add_argument('--retries', dest="retries", metavar="count", type=int, help="attempts of a request (default 20; 0 or 1: no retry)")
+p.add_argument('--max-timeout', dest="max_timeout", metavar="seconds", type=float, help="maximum timeout of an attempt; the timeout is estimated from the round-trip times (default 5)")
+p.add_argument('--function-timeout', dest="function_timeouts", metavar="id=seconds", action='append', default=[], help="fixed timeout of a function, like 0x42=10 (repeatable)")
+p.add_argument('--metrics', dest="metrics_dest", metavar="metrics-file", help="write the protocol metrics at the end of the run (JSON if the name ends with .json, Prometheus text format otherwise)")
+p.add_argument('--capture', dest="capture_dest", metavar="capture-file", help="record the bytes exchanged with the controller in a binary capture file")
+p.add_argument('--replay', dest="replay_source", metavar="capture-file", help="replay a capture file instead of opening the device (offline reproduction)")
+p.add_argument('--format', dest="format", type=int, choices=[1, 2], default=2, help="format of the backup file: 2 with a header and block checksums (default), 1 raw")
+p.add_argument('--region', dest="region", choices=["base", "extended", "all"], help="part of the NVM backed up: the first 6144 bytes (base), the rest (extended) or the whole NVM, its size detected (all, default with the format 2)")
+p.add_argument('--resume', dest="resume", action='store_true', help="resume an interrupted backup (same destination file) or full restoration (same source file)")
+p.add_argument('--refresh', dest="refresh", action='store_true', help="query the controller and node details again instead of using the cached ones")
+p.add_argument('--verify', dest="verify_source", metavar="backup-file", help="verify a backup file (no device needed)")
+p.add_argument('--repository', dest="repository", metavar="dir", help="repository of deduplicated backups (snapshots)")
+p.add_argument('--snapshot', dest="snapshot", action='store_true', help="backup the controller as a snapshot of the repository")
+p.add_argument('--list-snapshots', dest="list_snapshots", action='store_true', help="list the snapshots of the repository (no device needed)")
+p.add_argument('--diff-snapshots', dest="diff_snapshots", metavar="id", type=int, nargs=2, help="list the blocks that differ between two snapshots (no device needed)")
+p.add_argument('--export-snapshot', dest="export_snapshot", metavar=("id", "dest-file"), nargs=2, help="write a snapshot as a backup file, to be restored with -r (no device needed)")
+p.add_argument('--watch', dest="watch_interval", metavar="seconds", type=float, nargs='?', const=60, help="keep the device open, poll the node list and the home id every interval (default 60s) and backup (-b directory or --snapshot) only when they change")
 args = p.parse_args()
 
 # Initialize logging
@@ -30,28 +48,191 @@ else:
     level = logging.INFO
 logging.basicConfig(format='%(levelname)s: %(message)s', level=level, stream=sys.stdout)
 
+if args.manufacturers:
+    import zwbrlib.manufacturers as manufacturers
+    manufacturers.use_file(args.manufacturers)
+
+# Offline operations
+if args.verify_source:
+    import zwbrlib.imagefile as imagefile
+    try:
+        with open(args.verify_source, "rb") as f:
+            info = imagefile.read_info(f)
+            invalid = imagefile.verify(f)
+    except (OSError, imagefile.InvalidImage) as e:
+        logging.error("Invalid backup file: %s" % e)
+        sys.exit(2)
+    logging.info("format %d, home id %s, chip %s, version %s, %d blocks of %d bytes" % (
+        info.format, info.home_id, info.chip, info.version, info.block_count, info.block_size))
+    if len(invalid) > 0:
+        logging.error("Invalid blocks: %s" % invalid)
+        sys.exit(2)
+    logging.info("Backup file valid")
+    sys.exit(0)
+
+if (args.snapshot or args.list_snapshots or args.diff_snapshots or args.export_snapshot) and not args.repository:
+    p.error("the snapshot operations require a repository (--repository)")
+if args.list_snapshots or args.diff_snapshots or args.export_snapshot:
+    from zwbrlib.repository import BackupRepository, SnapshotNotFound
+    with BackupRepository(args.repository) as repository:
+        try:
+            if args.list_snapshots:
+                for snapshot in repository.snapshots():
+                    logging.info(snapshot.log_line())
+            if args.diff_snapshots:
+                blocks = repository.diff(*args.diff_snapshots)
+                for index, offset in blocks:
+                    logging.info("block %d (offset 0x%04X) differs" % (index, offset))
+                logging.info("%d blocks differ" % len(blocks))
+            if args.export_snapshot:
+                snapshot_id, dest = args.export_snapshot
+                repository.export(int(snapshot_id), dest, args.format)
+                logging.info("Snapshot %s written in '%s'" % (snapshot_id, dest))
+        except (SnapshotNotFound, ValueError) as e:
+            logging.error(e)
+            sys.exit(2)
+    sys.exit(0)
+
+devices = args.devices
+if len(devices) == 0:
+    p.error("the device is required")
+# Fleet mode for several devices, a pattern or a destination directory (a pattern may match one device)
+fleet = len(devices) > 1 or any(c in device for device in devices for c in "*?[") or \
+    (args.backup_dest != None and os.path.isdir(args.backup_dest) and args.watch_interval == None)
+if fleet:
+    from zwbrlib.fleet import expand_devices
+    devices = expand_devices(devices)
+    if len(devices) == 0:
+        sys.exit(1)
+
+# Retries and timeouts
+from zwbrlib.retry import RetryPolicy, parse_function_timeout
+try:
+    overrides = dict(parse_function_timeout(text) for text in args.function_timeouts)
+except ValueError:
+    p.error("invalid function timeout (expected id=seconds)")
+retry_policy = lambda: RetryPolicy(args.retries, args.max_timeout, overrides)
+
+# Part of the NVM backed up
+region_name = args.region or ("all" if args.format != 1 else "base")
+if args.format == 1 and region_name != "base":
+    p.error("the format 1 only holds the base region")
+if args.snapshot and region_name == "extended":
+    p.error("the repository only holds regions starting at the beginning of the NVM")
+
+# Fleet mode: backup of several controllers
+if fleet:
+    from zwbrlib.fleet import FleetBackup, log_summary
+    if not args.snapshot and (not args.backup_dest or not os.path.isdir(args.backup_dest)):
+        p.error("several devices require a destination directory (-b) or a repository (--snapshot)")
+    if args.nodes or args.restore_source or args.soft_reset:
+        p.error("only the backup is available with several devices or a destination directory")
+    if args.capture_dest or args.replay_source:
+        p.error("capture and replay are not available with several devices or a destination directory")
+    if args.watch_interval != None:
+        p.error("the watch mode is not available with several devices")
+    results = FleetBackup(devices, args.backup_dest, args.jobs, args.block_size, retry_policy, args.metrics_dest != None, args.format,
+                          args.repository if args.snapshot else None, region_name).exec()
+    log_summary(results)
+    if args.metrics_dest:
+        from zwbrlib.metrics import write as write_metrics
+        write_metrics(args.metrics_dest, [result.metrics for result in results])
+    sys.exit(0 if all(result.error == None for result in results) else 2)
+
+if args.watch_interval != None:
+    if not args.snapshot and (not args.backup_dest or not os.path.isdir(args.backup_dest)):
+        p.error("the watch mode requires a destination directory (-b) or a repository (--snapshot)")
+    if args.restore_source:
+        p.error("the watch mode is not available with a restoration")
+
 # Initialize controller access
-controller = Controller(args.device)
+from zwbrlib.controller import Controller
+metrics = None
+if args.metrics_dest:
+    from zwbrlib.metrics import Metrics
+    metrics = Metrics(device = devices[0])
+capture = transport_factory = None
+if args.capture_dest:
+    from zwbrlib.capture import CaptureWriter
+    capture = CaptureWriter(args.capture_dest)
+if args.replay_source:
+    from zwbrlib.capture import ReplayTransport
+    transport_factory = lambda device: ReplayTransport(args.replay_source, Controller.read_timeout)
+controller = Controller(devices[0], retry_policy(), metrics, capture, transport_factory)
 
 # Display controller type and version
+from zwbrlib.controllerdetails import ControllerDetails
+if args.refresh:
+    from zwbrlib.nodelist import NodeList
+    ControllerDetails.use_cache = False
+    NodeList.use_cache = False
 controller_details = ControllerDetails(controller)
 controller_details.log()
 
 # List nodes
 if args.nodes:
+    from zwbrlib.nodelist import NodeList
     nodes = NodeList(controller, controller_details, args.full_scan)
     nodes.log()
 
-if args.backup_dest:
-    backup = ZwBackup(controller, args.backup_dest)
+# Size of the NVM transfers
+block_size = args.block_size
+if block_size == None and (args.backup_dest or args.snapshot or args.watch_interval != None):
+    from zwbrlib.transfer import negotiate_block_size
+    block_size = negotiate_block_size(controller, controller_details)
+
+# Offset and size of the part of the NVM backed up
+region = None
+if args.backup_dest or args.snapshot or args.watch_interval != None:
+    from zwbrlib.nvmlayout import nvm_region
+    try:
+        region = nvm_region(controller, controller_details, region_name)
+    except ValueError as e:
+        logging.error("Invalid region: %s" % e)
+        sys.exit(2)
+
+if args.watch_interval != None:
+    from zwbrlib.backup import ZwBackup
+    from zwbrlib.watch import NetworkWatch
+    def watch_backup(controller):
+        details = ControllerDetails(controller)
+        if args.snapshot:
+            from zwbrlib.repository import BackupRepository
+            with BackupRepository(args.repository) as repository:
+                ZwBackup(controller, None, block_size, details, repository = repository, region = region).exec()
+        else:
+            from zwbrlib.fleet import backup_file_name
+            ZwBackup(controller, backup_file_name(args.backup_dest, details.home_id), block_size, details, args.format,
+                     region = region).exec()
+    try:
+        NetworkWatch(controller, watch_backup, args.watch_interval).exec()
+    except KeyboardInterrupt:
+        logging.info("Watch stopped")
+
+elif args.backup_dest:
+    from zwbrlib.backup import ZwBackup
+    backup = ZwBackup(controller, args.backup_dest, block_size, controller_details, args.format, resume = args.resume, region = region)
     try:
         backup.exec()
     except BaseException:
         logging.exception("Backup failed")
     del backup
 
+if args.snapshot and args.watch_interval == None:
+    from zwbrlib.backup import ZwBackup
+    from zwbrlib.repository import BackupRepository
+    with BackupRepository(args.repository) as repository:
+        backup = ZwBackup(controller, None, block_size, controller_details, repository = repository, region = region)
+        try:
+            backup.exec()
+        except BaseException:
+            logging.exception("Backup failed")
+        del backup
+
 if args.restore_source:
-    restore = ZwRestoration(controller, controller_details, args.restore_source)
+    from zwbrlib.restore import ZwRestoration
+    # The negotiated size is only checked with reads: the writes use the default size unless given
+    restore = ZwRestoration(controller, controller_details, args.restore_source, args.differential, args.block_size, args.resume)
     try:
         restore.exec()
     except BaseException:
@@ -63,3 +244,9 @@ elif args.soft_reset:
     controller.soft_reset()
 
 controller.close()
+if capture != None:
+    capture.close()
+
+if args.metrics_dest:
+    from zwbrlib.metrics import write as write_metrics
+    write_metrics(args.metrics_dest, [metrics])
@@ -0,0 +1,308 @@
+import asyncio
+import logging
+
+import zwbrlib.message as message
+from zwbrlib.message import Frame as Frame
+from zwbrlib.controller import Controller as Controller
+from zwbrlib.controller import ProtocolError as ProtocolError
+from zwbrlib.controllerdetails import ControllerDetails as ControllerDetails
+from zwbrlib.dataoperation import DataOperation as DtOp
+from zwbrlib.dataoperation import block_ranges as block_ranges
+import zwbrlib.imagefile as imagefile
+from zwbrlib.nodelist import NodeList as NodeList
+from zwbrlib.nodelist import node_ids_to_query as node_ids_to_query
+import zwbrlib.nvmlayout as nvmlayout
+from zwbrlib.retry import RetryPolicy as RetryPolicy
+from zwbrlib.transport import FrameParser as FrameParser
+
+class RequestFailed(Exception):
+    pass
+
+class AsyncController:
+    """ Z-Wave controller driven from an asyncio event loop.
+    Built on an asyncio stream (pyserial-asyncio for a serial port); the frames are read
+    by a task and dispatched like Controller does, with the same retry policy. Every call can be cancelled. """
+
+    # Time after which an incomplete frame is dropped (seconds)
+    frame_timeout = 0.1
+    # Default size of the queue of a subscriber
+    subscriber_queue_size = 64
+
+    def __init__(self, reader: asyncio.StreamReader, writer, retry_policy: RetryPolicy = None):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._reader = reader
+        self._writer = writer
+        self._parser = FrameParser()
+        self._link = asyncio.Queue()
+        self._waiting = dict()
+        # Late responses expected and late responses dropped while a request waits, by function id (see Controller)
+        self._stale = dict()
+        self._dropped = dict()
+        # Number of requests sent again
+        self.retry_count = 0
+        self._subscribers = list()
+        self._request_lock = asyncio.Lock()
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def open(cls, device, retry_policy: RetryPolicy = None):
+        """ Opens the serial port of the controller (requires pyserial-asyncio) """
+        try:
+            import serial_asyncio
+        except ImportError:
+            raise ImportError("The module pyserial-asyncio is required by AsyncController")
+        reader, writer = await serial_asyncio.open_serial_connection(url = device, baudrate = 115200)
+        controller = cls(reader, writer, retry_policy)
+        await controller._write_frame(message.nak)
+        if not await controller.wait_ready():
+            logging.warning("The controller does not answer")
+        return controller
+
+    async def close(self):
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
+        self._writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def subscribe(self, maxsize = None) -> asyncio.Queue:
+        """ Returns a bounded queue receiving the unsolicited data frames """
+        subscriber = asyncio.Queue(maxsize or AsyncController.subscriber_queue_size)
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        self._subscribers.remove(subscriber)
+
+    async def request(self, request_frame: Frame, reply_name, reply_arg1 = None, timeout = None):
+        """ Returns the reply of the request or None on failure.
+        asyncio.TimeoutError is raised when the whole request lasts more than timeout seconds. """
+        reply_frame = await asyncio.wait_for(self._get_reply_frame(request_frame), timeout)
+        if reply_frame != None:
+            reply_builder = getattr(reply_frame, reply_name)
+            if reply_arg1 == None:
+                return reply_builder()
+            else:
+                return reply_builder(reply_arg1)
+
+    async def get_details(self) -> ControllerDetails:
+        replies = list()
+        for request_builder, reply_name in ControllerDetails.REQUESTS:
+            replies.append(await self.request(request_builder(), reply_name))
+            if replies[-1] == None:
+                break
+        return ControllerDetails.from_replies(replies)
+
+    async def list_nodes(self, controller_details: ControllerDetails = None, full_scan = False) -> NodeList:
+        if controller_details == None:
+            controller_details = await self.get_details()
+        nodes = list()
+        for node_id in node_ids_to_query(controller_details, full_scan):
+            node = await self.request(message.request_GetNodeProtocolInfo(node_id), 'reply_GetNodeProtocolInfo', node_id)
+            if node != None:
+                nodes.append(node)
+        return NodeList.from_nodes(nodes)
+
+    async def detect_nvm_size(self, controller_details: ControllerDetails):
+        """ Size of the NVM, None if unknown (see nvmlayout.detect_nvm_size) """
+        reply_id = None
+        if nvmlayout.nvm_get_id_supported(controller_details):
+            reply_id = await self.request(message.request_NVMGetId(), 'reply_NVMGetId')
+        return nvmlayout.nvm_size_of(reply_id, controller_details)
+
+    async def backup(self, path, block_size = None, controller_details: ControllerDetails = None, region = None):
+        """ Writes the NVM (or the region, offset and size) to the file (which must not exist); nothing is written on failure.
+        The whole NVM is backed up by default, like the command line does. """
+        if controller_details == None:
+            controller_details = await self.get_details()
+        block_size = block_size or DtOp.block_size
+        nvm_offset, nvm_size = region or nvmlayout.region_range('all', await self.detect_nvm_size(controller_details))
+        with imagefile.ImageWriter(path, controller_details.home_id, controller_details.chip, controller_details.version, block_size,
+                                   region = (nvm_offset, nvm_size)) as writer:
+            for offset, length in block_ranges(block_size, nvm_offset, nvm_size):
+                data = await self._read_block(offset, length)
+                if data == None:
+                    raise RequestFailed("Read NVM failed at %d" % offset)
+                writer.write_block(data)
+            writer.commit()
+
+    async def _read_block(self, offset, length):
+        """ Returns the data of a block or None on failure; a short reply is read again (see DataOperation._read_block) """
+        for i in range(DtOp.read_retries):
+            reply_read = await self.request(message.request_ReadNVM(offset, length), 'reply_ReadNVM')
+            if reply_read == None:
+                return None
+            if len(reply_read.data) == length:
+                return reply_read.data
+            logging.warning("Read NVM at %d: %d bytes received, %d expected" % (offset, len(reply_read.data), length))
+        return None
+
+    async def restore(self, path, block_size = None, controller_details: ControllerDetails = None):
+        """ Resets the controller and writes the file to the NVM.
+        There is no confirmation: the caller is responsible for it. """
+        with open(path, "rb") as f:
+            try:
+                info, image = imagefile.load(f)
+            except imagefile.InvalidImage as e:
+                raise RequestFailed("Invalid source file (%s)" % e)
+        if info.offset != 0:
+            raise RequestFailed("The file holds a part of the NVM at %d: the reset would blank the rest" % info.offset)
+        if controller_details == None:
+            controller_details = await self.get_details()
+        # Checked before the reset, like ZwRestoration
+        nvm_size = await self.detect_nvm_size(controller_details) or DtOp.nvm_size
+        if info.size > nvm_size:
+            raise RequestFailed("The file ends at %d, beyond the NVM of the controller (%d bytes)" % (info.size, nvm_size))
+
+        reply_set_default = await self.request(message.request_SetDefault(), 'reply_SetDefault')
+        if reply_set_default == None:
+            raise RequestFailed("Failed to reset controller")
+        for offset, length in block_ranges(block_size or DtOp.block_size, info.offset, info.size):
+            start = offset - info.offset
+            reply_write = await self.request(message.request_WriteNVM(offset, image[start:start + length]), 'reply_WriteNVM')
+            if reply_write == None or not reply_write.success:
+                raise RequestFailed("Write NVM failed at %d" % offset)
+        await self.soft_reset()
+
+    async def soft_reset(self):
+        """ Performs a soft reset of the controller and waits until it is ready """
+        subscriber = self.subscribe()
+        try:
+            await self._write_frame(message.request_SoftReset())
+            return await self.wait_ready(subscriber)
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def wait_ready(self, subscriber: asyncio.Queue = None, timeout = None):
+        """ Waits for the SERIAL_API_STARTED notification (with a subscriber) or a reply
+        to a cheap request. Returns False after the timeout. """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + (timeout or Controller.ready_timeout)
+        while loop.time() < deadline:
+            try:
+                while subscriber != None:
+                    frame = await asyncio.wait_for(subscriber.get(), Controller.ready_poll_timeout)
+                    if frame.get_func_id() == message.FUNC_ID_SERIAL_API_STARTED[0]:
+                        return True
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if await asyncio.wait_for(self._get_reply_frame(message.request_GetVersion(), 1), Controller.ready_poll_timeout * 2) != None:
+                    return True
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    async def _get_reply_frame(self, request_frame: Frame, retries = None) -> Frame:
+        """ Returns the reply frame of the given request or None on failure (see Controller.get_reply_frame) """
+        expected_func_id = request_frame.get_func_id()
+        policy = self.retry_policy
+        async with self._request_lock:
+            responses = asyncio.Queue()
+            self._waiting[expected_func_id] = responses
+            self._dropped[expected_func_id] = 0
+            acknowledged = 0
+            try:
+                measurable = True
+                for i in range(retries or policy.attempts(expected_func_id)):
+                    if i > 0:
+                        self.retry_count += 1
+                    attempt_timeout = policy.timeout(expected_func_id)
+                    while not self._link.empty():
+                        self._link.get_nowait()
+                    loop = asyncio.get_event_loop()
+                    start = loop.time()
+                    await self._write_frame(request_frame)
+                    link_frame = await self._ack_received(attempt_timeout)
+                    if link_frame == None:
+                        policy.timed_out(expected_func_id)
+                        measurable = False
+                        continue
+                    if not link_frame.is_ack():
+                        await asyncio.sleep(policy.backoff(i))
+                        continue
+                    acknowledged += 1
+                    try:
+                        frame = await asyncio.wait_for(responses.get(), attempt_timeout)
+                    except asyncio.TimeoutError:
+                        logging.debug("No response to function %d" % expected_func_id)
+                        policy.timed_out(expected_func_id)
+                        measurable = False
+                        continue
+                    if measurable:
+                        policy.observe(expected_func_id, loop.time() - start)
+                    acknowledged -= 1
+                    return frame
+            finally:
+                del self._waiting[expected_func_id]
+                late = acknowledged - responses.qsize() - self._dropped.pop(expected_func_id)
+                if late > 0:
+                    self._stale[expected_func_id] = self._stale.get(expected_func_id, 0) + late
+
+    async def _ack_received(self, timeout):
+        """ Returns the ACK, NAK or CAN frame received; None on timeout """
+        try:
+            frame = await asyncio.wait_for(self._link.get(), timeout)
+        except asyncio.TimeoutError:
+            logging.debug("No ACK received")
+            return None
+        if frame.is_ack() or frame.is_nak() or frame.is_can():
+            return frame
+        logging.error("Unexpected frame %s" % frame.frame.hex())
+        raise ProtocolError("Unexpected frame received")
+
+    async def _read_loop(self):
+        while True:
+            if self._parser.pending() == 0:
+                data = await self._reader.read(1024)
+            else:
+                try:
+                    data = await asyncio.wait_for(self._reader.read(1024), AsyncController.frame_timeout)
+                except asyncio.TimeoutError:
+                    self._parser.drop_incomplete()
+                    await self._write_frame(message.nak)
+                    continue
+            if len(data) == 0:
+                logging.debug("End of stream")
+                return
+            self._parser.feed(data)
+            for frame in self._parser.frames():
+                if frame is message.discarded:
+                    await self._write_frame(message.nak)
+                elif frame.is_data():
+                    await self._write_frame(message.ack)
+                    self._dispatch(frame)
+                else:
+                    self._link.put_nowait(frame)
+
+    def _dispatch(self, frame: Frame):
+        func_id = frame.get_func_id()
+        if self._stale.get(func_id, 0) > 0:
+            logging.debug("Late response function %d dropped" % func_id)
+            self._stale[func_id] -= 1
+            if func_id in self._dropped:
+                self._dropped[func_id] += 1
+            return
+        responses = self._waiting.get(func_id)
+        if responses != None:
+            responses.put_nowait(frame)
+            return
+        logging.debug("Unsolicited frame function %d" % frame.get_func_id())
+        for subscriber in self._subscribers:
+            if subscriber.full():
+                # Drop the oldest frame
+                subscriber.get_nowait()
+            subscriber.put_nowait(frame)
+
+    async def _write_frame(self, frame: Frame):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("To write %s/%d" % (frame.frame.hex(), len(frame.frame)))
+        self._writer.write(frame.frame)
+        await self._writer.drain()
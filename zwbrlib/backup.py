@@ -1,44 +1,81 @@
 import logging
-import os
 
 from zwbrlib.controller import Controller as Controller
+from zwbrlib.controllerdetails import ControllerDetails as ControllerDetails
 from zwbrlib.dataoperation import DataOperation as DtOp
-import zwbrlib.message as message
+import zwbrlib.imagefile as imagefile
+from zwbrlib.journal import Journal as Journal
+from zwbrlib.journal import JOURNAL_SUFFIX as JOURNAL_SUFFIX
+from zwbrlib.repository import RepositoryWriter as RepositoryWriter
 
 class BackupFailed(Exception):
     pass
 
 class ZwBackup(DtOp):
-    """ Backup operation"""
+    """ Backup operation.
+    The file is written to a temporary file renamed on success: the destination file
+    never contains a partial backup.
+    With a repository, the backup is recorded as a snapshot of the repository instead of a file.
+    The blocks read are recorded in a journal next to the file: a failed backup is resumed
+    from the first block not read. """
 
-    def __init__(self, controller: Controller, file):
-        super().__init__("Backup ")
-        self._controller = controller
+    def __init__(self, controller: Controller, file, block_size = None, controller_details: ControllerDetails = None, format = imagefile.FORMAT_VERSION, repository = None, resume = False, region = None):
+        """ region is the part of the NVM backed up (offset and size), see DataOperation """
+        super().__init__("Backup ", controller, block_size, region)
         self._file = file
-        self._started = False
-        self._success = False
-
-    def __del__(self):
-        if self._started and not self._success:
-            os.remove(self._file)
-            logging.info("File '%s' removed" % self._file)
+        self._resume = resume
+        self._repository = repository
+        self.snapshot_id = None
+        self._controller_details = controller_details
+        self._format = format
 
     def exec(self):
         logging.info("--- backup ------")
-        with open(self._file, "xb") as f:
-            self._started = True
-            for count in range(0, DtOp.block_count):
-                reply_read = self._controller.request(message.request_ReadNVM(count * DtOp.block_size, DtOp.block_size), 'reply_ReadNVM')
-                if reply_read == None:
-                    self.progressDone()
-                    raise BackupFailed("Read NVM failed")
-                f.write(reply_read.data)
-                self.progress(count + 1)
-
-        # Check the size of the file
-        file_size = os.stat(self._file).st_size
-        if file_size != self.getExpectedSize():
-            raise BackupFailed("Wrong file size %d <> %d" % (file_size, self.getExpectedSize()))
-
-        self._success = True
+        self.started()
+        details = self._controller_details
+        if self._repository != None:
+            if details == None:
+                raise BackupFailed("The controller details are required by a repository")
+            if self.nvm_offset != 0:
+                raise BackupFailed("A repository only holds parts starting at the beginning of the NVM")
+            writer = RepositoryWriter(self._repository, details.home_id, details.chip, details.version, self.nvm_size)
+        else:
+            writer = imagefile.ImageWriter(self._file, details.home_id if details else None, details.chip if details else None,
+                                           details.version if details else None, self.block_size, self._format,
+                                           (self.nvm_offset, self.nvm_size))
+        header = {'operation': 'backup', 'home_id': details.home_id if details else None, 'block_size': self.block_size,
+                  'offset': self.nvm_offset, 'size': self.nvm_size}
+        journal = Journal(self._file + JOURNAL_SUFFIX if self._repository == None else None, header, self._resume)
+        if journal.completed() > 0:
+            logging.info("Backup resumed at block %d" % journal.completed())
+        try:
+            with writer:
+                for count in range(0, self.block_count):
+                    data = journal.data(count)
+                    if data == None:
+                        data = self._read_block(count)
+                        if data == None:
+                            self.progressDone()
+                            raise BackupFailed("Read NVM failed")
+                        journal.record(count, data, True)
+                    writer.write_block(data)
+                    self.progress(count + 1)
+                writer.commit()
+        finally:
+            journal.close()
+        journal.remove()
+
+        if self._repository != None:
+            self.snapshot_id = writer.snapshot_id
+            logging.info("Snapshot %d recorded" % self.snapshot_id)
+        else:
+            self._verify_file()
+
+        self.done(self.getExpectedSize(), self.block_count)
         logging.info("--- done --------")
+
+    def _verify_file(self):
+        with open(self._file, "rb") as f:
+            invalid = imagefile.verify(f)
+        if len(invalid) > 0:
+            raise BackupFailed("Invalid blocks %s in '%s'" % (invalid, self._file))
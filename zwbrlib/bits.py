@@ -8,3 +8,64 @@ def is_id_set(bit_field, bit_id):
     index = int(bit_pos / 8)
     shift = bit_pos % 8
     return bit_field[index] & (1 << shift) != 0
+
+class NodeBitmap:
+    """ Set of ids (nodes, function ids) backed by an int: id 1 => bit 0, id 2 => bit 1 and so on.
+    Same layout as the bit fields of the serial API (read as a little endian integer). """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value = 0):
+        self.value = value
+
+    @classmethod
+    def from_bytes(cls, bit_field):
+        return cls(int.from_bytes(bit_field, 'little'))
+
+    @classmethod
+    def from_ids(cls, ids):
+        value = 0
+        for bit_id in ids:
+            value |= 1 << (bit_id - 1)
+        return cls(value)
+
+    def to_bytes(self, length):
+        return self.value.to_bytes(length, 'little')
+
+    def __contains__(self, bit_id):
+        return bit_id > 0 and (self.value >> (bit_id - 1)) & 1 != 0
+
+    def __iter__(self):
+        """ Set ids, in increasing order; only the set bits are visited """
+        value = self.value
+        while value:
+            lowest = value & -value
+            yield lowest.bit_length()
+            value ^= lowest
+
+    def __len__(self):
+        return bin(self.value).count('1')
+
+    def __bool__(self):
+        return self.value != 0
+
+    def __or__(self, other):
+        return NodeBitmap(self.value | other.value)
+
+    def __and__(self, other):
+        return NodeBitmap(self.value & other.value)
+
+    def __sub__(self, other):
+        return NodeBitmap(self.value & ~other.value)
+
+    def __xor__(self, other):
+        return NodeBitmap(self.value ^ other.value)
+
+    def __eq__(self, other):
+        return isinstance(other, NodeBitmap) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return "NodeBitmap(%s)" % list(self)
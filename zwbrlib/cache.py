@@ -0,0 +1,42 @@
+import json
+import logging
+import os
+import tempfile
+
+def cache_dir():
+    """ Directory of the cached data (ZWBR_CACHE_DIR, XDG_CACHE_HOME or ~/.cache) """
+    path = os.environ.get('ZWBR_CACHE_DIR')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'zwbr')
+
+def cache_path(name):
+    return os.path.join(cache_dir(), name)
+
+def load(name):
+    """ Returns the cached content or an empty dict """
+    try:
+        with open(cache_path(name + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def save(name, content):
+    """ Saves the content; a failure is not fatal """
+    path = cache_path(name + '.json')
+    temp = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # A temporary file per writer: the controllers of a fleet save at the same time
+        fd, temp = tempfile.mkstemp(prefix = name + '.', suffix = '.tmp', dir = os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f, indent = 1, sort_keys = True)
+        os.replace(temp, path)
+    except OSError as e:
+        logging.debug("Cache '%s' not saved: %s" % (path, e))
+        if temp != None and os.path.exists(temp):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
@@ -0,0 +1,122 @@
+import logging
+import struct
+import threading
+import time
+
+import zwbrlib.message as message
+from zwbrlib.transport import FrameParser as FrameParser
+from zwbrlib.transport import DIRECTION_IN, DIRECTION_OUT
+
+# Capture file: header, then records (timestamp in seconds since the start of the capture,
+# direction, length) each followed by the raw bytes
+CAPTURE_MAGIC = b'ZWBRCAP1'
+RECORD = struct.Struct('<dBH')
+
+class CaptureWriter:
+    """ Appends the raw bytes exchanged with the controller to a capture file """
+
+    def __init__(self, path):
+        self._file = open(path, 'xb')
+        self._file.write(CAPTURE_MAGIC)
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, direction, data):
+        with self._lock:
+            self._file.write(RECORD.pack(time.monotonic() - self._start, direction, len(data)))
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class InvalidCapture(Exception):
+    pass
+
+def read_capture(path):
+    """ Returns the records of a capture file: (timestamp, direction, data) """
+    records = list()
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise InvalidCapture("Not a capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) == 0:
+                break
+            if len(header) < RECORD.size:
+                raise InvalidCapture("Truncated capture file")
+            timestamp, direction, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise InvalidCapture("Truncated capture file")
+            records.append((timestamp, direction, data))
+    return records
+
+class ReplayTransport:
+    """ Transport replaying a capture instead of a serial port.
+    The received bytes are given back in their original order: each chunk is released once
+    the bytes written before it in the capture have been written again. The written bytes
+    are compared to the captured ones. With realtime, the original delays are kept. """
+
+    def __init__(self, path, read_timeout, realtime = False):
+        self._read_timeout = read_timeout
+        self._realtime = realtime
+        self._parser = FrameParser()
+        self._open = True
+        # Captured outgoing bytes and received chunks with the count of bytes written before
+        self._expected_out = bytearray()
+        self._chunks = list()
+        for timestamp, direction, data in read_capture(path):
+            if direction == DIRECTION_OUT:
+                self._expected_out += data
+            else:
+                self._chunks.append((len(self._expected_out), timestamp, data))
+        self._next_chunk = 0
+        self._written = 0
+        self._diverged = False
+        self._condition = threading.Condition()
+        self._start = time.monotonic()
+
+    def __str__(self):
+        return "replay (%d chunks, %d bytes written)" % (len(self._chunks), len(self._expected_out))
+
+    def is_open(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+    def finished(self):
+        """ Tells if all the captured chunks have been replayed """
+        return self._next_chunk == len(self._chunks)
+
+    def read_frames(self):
+        with self._condition:
+            if not self._chunk_available():
+                self._condition.wait(self._read_timeout)
+            if not self._chunk_available():
+                if self._parser.drop_incomplete():
+                    return [message.discarded]
+                return []
+            written_before, timestamp, data = self._chunks[self._next_chunk]
+            self._next_chunk += 1
+        if self._realtime:
+            delay = timestamp - (time.monotonic() - self._start)
+            if delay > 0:
+                time.sleep(delay)
+        self._parser.feed(data)
+        return list(self._parser.frames())
+
+    def write(self, *frames):
+        data = b''.join(frame.frame for frame in frames)
+        expected = self._expected_out[self._written:self._written + len(data)]
+        if not self._diverged and expected != data:
+            self._diverged = True
+            logging.warning("Replay diverges at byte %d: %s written, %s captured" % (self._written, data.hex(), bytes(expected).hex()))
+        with self._condition:
+            self._written += len(data)
+            self._condition.notify_all()
+        return len(data)
+
+    def _chunk_available(self):
+        return self._next_chunk < len(self._chunks) and self._chunks[self._next_chunk][0] <= self._written
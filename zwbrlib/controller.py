@@ -1,47 +1,166 @@
 import serial
 import time
 import logging
+import queue
+import threading
 
 import zwbrlib.message as message
 from zwbrlib.message import Frame as Frame
+from zwbrlib.transport import SerialTransport as SerialTransport
+from zwbrlib.retry import RetryPolicy as RetryPolicy
+from zwbrlib.metrics import no_metrics as no_metrics
 
 class ProtocolError(Exception):
     pass
 
 class Controller:
-    """Z-Wave controller accessible through a serial port"""
+    """Z-Wave controller accessible through a serial port.
+    A reader thread reads the frames continuously: data frames are acknowledged at once,
+    the responses are given to the waiting request (by function id) and the unsolicited
+    frames are given to the subscribers."""
 
-    def __init__(self, device):
-        self.__device = serial.Serial(port=device,  baudrate=115200)
-        self.__device.timeout = 5
-        logging.debug(self.__device)
+    # Timeout of the reads of the reader thread (seconds)
+    read_timeout = 0.1
+    # Default size of the queue of a subscriber
+    subscriber_queue_size = 64
+    # Maximum time to wait for the controller to be ready, at open and after a soft reset (seconds)
+    ready_timeout = 10
+    # Timeout of a readiness poll (seconds)
+    ready_poll_timeout = 0.2
+
+    def __init__(self, device, retry_policy: RetryPolicy = None, metrics = None, capture = None, transport_factory = None):
+        """ capture records the exchanged bytes (zwbrlib.capture.CaptureWriter);
+        transport_factory(device) replaces the serial port (like zwbrlib.capture.ReplayTransport) """
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Protocol metrics (zwbrlib.metrics.Metrics), not collected by default
+        self.metrics = metrics or no_metrics
+        self._capture = capture
+        self._transport_factory = transport_factory
+        logging.debug("Request budget: %d attempts, %.1fs" % self.retry_policy.budget(None))
+        # Current device (may change after a soft reset) and its USB id to follow it
+        self.device = device
+        self._usb_id = find_usb_id(device) if transport_factory == None else None
+        self._write_lock = threading.Lock()
+        self._pending_ack = False
+        self._lock = threading.Lock()
+        # Link frames (ACK, NAK, CAN) of the current request
+        self._link = queue.Queue()
+        # Queue of the waiting request, by function id
+        self._waiting = dict()
+        # Late responses expected, by function id: a request sent again after a response
+        # timeout may be answered twice, the extra response must not answer the next request
+        self._stale = dict()
+        # Late responses dropped while a request waits, by function id
+        self._dropped = dict()
+        self._subscribers = list()
+        # Number of requests sent again
+        self.retry_count = 0
+        self._open(device)
         self._write_frame(message.nak)
-        time.sleep(1)
+        if not self.wait_ready():
+            logging.warning("The controller does not answer")
+
+    def identity(self):
+        """ Identity of the controller device: USB id when known, device otherwise """
+        if self._usb_id != None:
+            return "%04X:%04X:%s" % self._usb_id
+        return self.device
 
     def __del__(self):
         try:
-            if self.__device.isOpen():
+            if self._transport.is_open():
                 self.close()
-            logging.debug(self.__device)
+            logging.debug(self._transport)
         except:
             pass
 
     def close(self):
-        self.__device.close()
+        self._running = False
+        if self._reader.is_alive() and self._reader is not threading.current_thread():
+            self._reader.join()
+        try:
+            self._flush_ack()
+        except (serial.SerialException, OSError):
+            pass
+        self._transport.close()
+
+    def _open(self, device):
+        """ Opens the device (pending input dropped) and starts the reader thread """
+        if self._transport_factory != None:
+            self._transport = self._transport_factory(device)
+        else:
+            self._transport = SerialTransport(device, Controller.read_timeout, self.metrics, self._capture)
+        self._pending_ack = False
+        self._running = True
+        self._reader = threading.Thread(target = self._read_loop, name = "zwbr-reader %s" % device, daemon = True)
+        self._reader.start()
 
     def soft_reset(self):
-        """ Performs a soft reset of the controller.
-        The opened handler may not be valid after this call"""
+        """ Performs a soft reset of the controller and waits until it is ready.
+        When the OS device id changes, the controller follows the device (same USB id)."""
         logging.info("--- soft reset --")
-        request_frame = message.request_SoftReset()
-        self._write_frame(request_frame)
-        time.sleep(2)
+        subscriber = self.subscribe()
+        try:
+            request_frame = message.request_SoftReset()
+            self._write_frame(request_frame)
+            ready = self.wait_ready(subscriber)
+        finally:
+            self.unsubscribe(subscriber)
         logging.info("--- done --------")
-        logging.info("")
-        logging.info("The OS device id may have changed")
+        if not ready:
+            logging.info("")
+            logging.warning("The controller is not ready, the OS device id may have changed")
+
+    def wait_ready(self, subscriber: queue.Queue = None, timeout = None):
+        """ Waits until the controller is ready: SERIAL_API_STARTED notification received
+        (with a subscriber) or cheap request answered. Returns False after the timeout. """
+        deadline = time.monotonic() + (timeout or Controller.ready_timeout)
+        while time.monotonic() < deadline:
+            if subscriber != None and _started(subscriber, Controller.ready_poll_timeout):
+                logging.debug("Serial API started")
+                return True
+            if not self._reader.is_alive() and not self._follow_device():
+                time.sleep(Controller.ready_poll_timeout)
+                continue
+            try:
+                if self.get_reply_frame(message.request_GetVersion(), 1, Controller.ready_poll_timeout) != None:
+                    return True
+            except (serial.SerialException, OSError) as e:
+                logging.debug("Device not available: %s" % e)
+                if not self._follow_device():
+                    time.sleep(Controller.ready_poll_timeout)
+        return False
+
+    def _follow_device(self):
+        """ Opens again the device, found by its USB id when it has been re-enumerated """
+        device = find_device(self._usb_id) if self._usb_id != None else self.device
+        if device == None:
+            return False
+        self.close()
+        try:
+            self._open(device)
+        except (serial.SerialException, OSError) as e:
+            logging.debug("Device %s not opened: %s" % (device, e))
+            return False
+        if device != self.device:
+            logging.info("The OS device id has changed: %s" % device)
+            self.device = device
+        return True
+
+    def subscribe(self, maxsize = None) -> queue.Queue:
+        """ Returns a bounded queue receiving the unsolicited data frames.
+        The oldest frames are dropped when the queue is full. """
+        subscriber = queue.Queue(maxsize or Controller.subscriber_queue_size)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            self._subscribers.remove(subscriber)
 
-    def request(self, request_frame: Frame, reply_name, reply_arg1 = None):
-        reply_frame = self._get_reply_frame(request_frame)
+    def request(self, request_frame: Frame, reply_name, reply_arg1 = None, retries = None, timeout = None):
+        reply_frame = self.get_reply_frame(request_frame, retries, timeout)
         if reply_frame != None:
             reply_builder = getattr(reply_frame, reply_name)
             if reply_arg1 == None:
@@ -49,74 +168,203 @@ class Controller:
             else:
                 return reply_builder(reply_arg1)
 
-    def _get_reply_frame(self, request_frame: Frame) -> Frame:
-        """ Returns the reply frame of the given request or None on failure """
+    def get_reply_frame(self, request_frame: Frame, retries = None, timeout = None) -> Frame:
+        """ Returns the reply frame of the given request or None on failure.
+        retries and timeout (ACK and response of each attempt) override the retry policy. """
         expected_func_id = request_frame.get_func_id()
-        for i in range(20):
-            self._write_frame(request_frame)
-            if not self._ack_received():
-                # Retry
-                continue
+        policy = self.retry_policy
+        metrics = self.metrics
+        retries = retries if retries != None else policy.attempts(expected_func_id)
+        metrics.count('requests', expected_func_id)
+        responses = queue.Queue()
+        with self._lock:
+            self._waiting[expected_func_id] = responses
+            self._dropped[expected_func_id] = 0
+        # Transmissions acknowledged by the controller (each one may be answered)
+        acknowledged = 0
+        try:
+            # A reply after a timeout may answer any transmission: no RTT measure
+            measurable = True
+            for i in range(retries):
+                if i > 0:
+                    self.retry_count += 1
+                    metrics.count('retries', expected_func_id)
+                attempt_timeout = timeout or policy.timeout(expected_func_id)
+                self._clear_link()
+                start = time.monotonic()
+                self._write_frame(request_frame)
+                link_frame = self._ack_received(attempt_timeout)
+                if link_frame == None:
+                    metrics.count('ack_timeouts', expected_func_id)
+                    policy.timed_out(expected_func_id)
+                    measurable = False
+                    continue
+                if not link_frame.is_ack():
+                    # NAK or CAN: retry after a delay
+                    metrics.count('nak' if link_frame.is_nak() else 'can', expected_func_id)
+                    time.sleep(policy.backoff(i))
+                    continue
 
-            frame = self._read_frame()
-            if frame.is_data() and expected_func_id == frame.get_func_id():
-                self._write_frame(message.ack)
+                acknowledged += 1
+                try:
+                    frame = responses.get(timeout = attempt_timeout)
+                except queue.Empty:
+                    logging.debug("No response to function %d" % expected_func_id)
+                    metrics.count('response_timeouts', expected_func_id)
+                    policy.timed_out(expected_func_id)
+                    measurable = False
+                    continue
+                rtt = time.monotonic() - start
+                metrics.observe_latency(expected_func_id, rtt)
+                if measurable:
+                    policy.observe(expected_func_id, rtt)
+                acknowledged -= 1
                 return frame
-            self._accept_ignorable_frame(frame)
+            metrics.count('failures', expected_func_id)
+        finally:
+            with self._lock:
+                del self._waiting[expected_func_id]
+                # Responses of the other transmissions still to come: a response dropped
+                # during the request may be the one of a transmission of the request
+                late = acknowledged - responses.qsize() - self._dropped.pop(expected_func_id)
+                if late > 0:
+                    self._stale[expected_func_id] = self._stale.get(expected_func_id, 0) + late
 
-    def _ack_received(self):
-        frame = self._read_frame()
+    def _clear_link(self):
+        while True:
+            try:
+                self._link.get_nowait()
+            except queue.Empty:
+                return
+
+    def _ack_received(self, timeout):
+        """ Returns the ACK, NAK or CAN frame received; None on timeout """
+        try:
+            frame = self._link.get(timeout = timeout)
+        except queue.Empty:
+            logging.debug("No ACK received")
+            return None
         if frame.is_ack():
-            return True
-        self._accept_ignorable_frame(frame)
-        return False
+            return frame
+        if frame.is_nak() or frame.is_can():
+            logging.debug("%s received" % ("NAK" if frame.is_nak() else "CAN"))
+            return frame
+        logging.error("Unexpected frame %s" % frame.frame.hex())
+        raise ProtocolError("Unexpected frame received")
 
-    def _accept_ignorable_frame(self, frame: Frame):
-        if frame.is_data():
-            # ACK data (especially request command handler, func_id=0x04)
-            self._write_frame(message.ack)
-            logging.debug("Ignoring frame function %d" % frame.get_func_id())
-        elif frame.is_can():
-            # Ignore CAN
-            logging.debug("CAN received")
+    def _read_loop(self):
+        """ Reader thread """
+        while self._running:
+            try:
+                frames = self._transport.read_frames()
+                if len(frames) == 0:
+                    # Idle line
+                    self._flush_ack()
+                for frame in frames:
+                    self._handle_frame(frame)
+            except (serial.SerialException, OSError) as e:
+                if self._running:
+                    logging.debug("Reader stopped: %s" % e)
+                return
+
+    def _handle_frame(self, frame: Frame):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Read %s/%d" % (frame.frame.hex(), len(frame.frame)))
+        if frame is message.discarded:
+            # Invalid data frame, ask for a retransmission
+            self.metrics.count('discarded_frames')
+            self._write_frame(message.nak)
+        elif frame.is_data():
+            self._dispatch(frame)
         else:
-            logging.error("Unexpected frame %s" % frame.frame.hex())
-            raise ProtocolError("Unexpected frame received")
+            self._link.put(frame)
+
+    def _dispatch(self, frame: Frame):
+        """ Gives a data frame to the waiting request or to the subscribers """
+        func_id = frame.get_func_id()
+        with self._lock:
+            stale = self._stale.get(func_id, 0) > 0
+            if stale:
+                self._stale[func_id] -= 1
+                if func_id in self._dropped:
+                    self._dropped[func_id] += 1
+            responses = self._waiting.get(func_id) if not stale else None
+            subscribers = list(self._subscribers)
+        if stale:
+            # Late response of a request answered since: dropped (a lost one only costs a retry)
+            logging.debug("Late response function %d dropped" % func_id)
+            self.metrics.count('late_responses', func_id)
+            self._write_frame(message.ack)
+            return
+        if responses != None:
+            # ACK sent with the next request
+            with self._write_lock:
+                self._pending_ack = True
+            responses.put(frame)
+            return
+
+        self._write_frame(message.ack)
+
+        logging.debug("Unsolicited frame function %d" % func_id)
+        self.metrics.count('unsolicited_frames', func_id)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(frame)
+                    break
+                except queue.Full:
+                    # Drop the oldest frame
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
 
     def _write_frame(self, frame: Frame):
-        logging.debug("To write %s/%d" % (frame.frame.hex(), len(frame.frame)))
-        n = self.__device.write(frame.frame)
-        self.__device.flush()
-        logging.debug("wrote %d" % (n))
-
-    def _read_frame(self) -> Frame:
-        """ Returns a frame read or a dummy frame when data have been discarded """
-        type = self.__device.read()
-        if len(type) < 1:
-            logging.debug("No frame read")
-            return message.none
-
-        frame = Frame(type)
-        if not frame.is_data():
-            logging.debug("Read %s/%d" % (frame.frame.hex(), len(frame.frame)))
-            return frame
+        with self._write_lock:
+            if self._pending_ack and frame is not message.ack:
+                frames = (message.ack, frame)
+            else:
+                frames = (frame,)
+            self._pending_ack = False
+            n = self._transport.write(*frames)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Wrote %s/%d" % (''.join(written.frame.hex() for written in frames), n))
+
+    def _flush_ack(self):
+        """ Sends the pending ACK, if any """
+        with self._write_lock:
+            if not self._pending_ack:
+                return
+            self._pending_ack = False
+            self._transport.write(message.ack)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Wrote %s/1" % message.FRAME_ACK.hex())
+
+def _started(subscriber: queue.Queue, timeout):
+    """ Tells if a SERIAL_API_STARTED notification is received before the timeout """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            frame = subscriber.get(timeout = max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            return False
+        if frame.get_func_id() == message.FUNC_ID_SERIAL_API_STARTED[0]:
+            return True
+
+def find_usb_id(device):
+    """ USB id (vid, pid, serial number) of a device; None when not an USB device """
+    import os
+    from serial.tools import list_ports
+    path = os.path.realpath(device)
+    for port in list_ports.comports():
+        if port.vid != None and port.serial_number and os.path.realpath(port.device) == path:
+            return (port.vid, port.pid, port.serial_number)
+    return None
 
-        # Read data frame
-        length = self.__device.read()[0]
-        payload = self.__device.read(length)
-        expected_checksum = payload[length-1]
-        # Verify checksum
-        checksum = message.compute_checksum(length, payload)
-        if expected_checksum != checksum:
-            # Discard data, including pending data
-            logging.debug("Discard invalid frame (checksum); consume pending data")
-            waiting = self.__device.in_waiting()
-            if waiting > 0:
-                self.__device.read(waiting)
-
-            return message.discarded
-
-        # Return frame (without checksum)
-        frame = Frame(type + bytes([length]) + payload)
-        logging.debug("Read %s/%d" % (frame.frame.hex(), len(frame.frame)))
-        return frame
+def find_device(usb_id):
+    """ Device having the USB id or None """
+    from serial.tools import list_ports
+    for port in list_ports.comports():
+        if (port.vid, port.pid, port.serial_number) == usb_id:
+            return port.device
+    return None
@@ -1,45 +1,117 @@
 import logging
 
 import zwbrlib.bits as bits
+import zwbrlib.cache as cache
 from zwbrlib.controller import Controller as Controller
 import zwbrlib.message as message
+from zwbrlib.message import Frame as Frame
+
+CACHE_NAME = 'controllers'
 
 class DeviceNotAvailable(Exception):
     pass
 
 class ControllerDetails:
 
+    # Requests giving the details: request builder and reply name
+    REQUESTS = (
+        (message.request_SerialApiGetInitData, 'reply_SerialApiGetInitData'),
+        (message.request_GetVersion, 'reply_GetVersion'),
+        (message.request_MemoryGetId, 'reply_MemoryGetId'),
+        (message.request_SerialApiGetCapabilities, 'reply_SerialApiGetCapabilities'),
+        )
+    # Requests sent at each run (cheap): the node list and the home id, key of the cached replies
+    KEY_REQUESTS = (0, 2)
+
+    # Replies kept in the cache directory by device, home id and node list (a restored stick has
+    # the home id and node list of another one): a hit only saves the version and capabilities
+    # requests; False queries all the details (they are still cached)
+    use_cache = True
+
     def __init__(self, controller: Controller):
+        frames = [None] * len(ControllerDetails.REQUESTS)
+        for index in ControllerDetails.KEY_REQUESTS:
+            frames[index] = ControllerDetails._request(controller, index)
+        self._cache_key = None
+        if all(frames[index] != None for index in ControllerDetails.KEY_REQUESTS):
+            self._cache_key = ControllerDetails._cache_key_of(controller, frames)
+        cached = ControllerDetails._load(self._cache_key) if self._cache_key != None and ControllerDetails.use_cache else None
+        for index in range(len(ControllerDetails.REQUESTS)):
+            if index not in ControllerDetails.KEY_REQUESTS and self._cache_key != None:
+                frames[index] = cached[index] if cached != None else ControllerDetails._request(controller, index)
+        self._set_replies([getattr(Frame(frame), reply_name)() if frame != None else None
+                           for frame, (request_builder, reply_name) in zip(frames, ControllerDetails.REQUESTS)])
+        if frames != cached:
+            ControllerDetails._save(self._cache_key, frames)
+
+    @staticmethod
+    def _request(controller: Controller, index):
+        """ Reply frame of a request of REQUESTS or None """
+        reply_frame = controller.get_reply_frame(ControllerDetails.REQUESTS[index][0]())
+        return bytes(reply_frame.frame) if reply_frame != None else None
+
+    @staticmethod
+    def _cache_key_of(controller: Controller, frames):
+        """ Key of the cached replies: device identity, home id and node id, then the init data (node list and chip) """
+        return "%s/%s/%s" % (controller.identity(), frames[2].hex(), frames[0].hex())
+
+    @staticmethod
+    def _load(key):
+        """ Cached reply frames of REQUESTS or None """
+        try:
+            frames = [bytes.fromhex(text) for text in cache.load(CACHE_NAME)[key]]
+        except (KeyError, TypeError, ValueError):
+            return None
+        return frames if len(frames) == len(ControllerDetails.REQUESTS) else None
+
+    @staticmethod
+    def _save(key, frames):
+        cached = cache.load(CACHE_NAME)
+        if frames != None:
+            cached[key] = [frame.hex() for frame in frames]
+        else:
+            cached.pop(key, None)
+        cache.save(CACHE_NAME, cached)
+
+    def forget(self):
+        """ Removes the cached details of the controller (NVM modified) """
+        if getattr(self, '_cache_key', None) != None:
+            ControllerDetails._save(self._cache_key, None)
+
+    @classmethod
+    def from_replies(cls, replies):
+        """ Details built from the replies of REQUESTS (same order) """
+        details = cls.__new__(cls)
+        details._set_replies(replies)
+        return details
 
-        # Get serial api init data, get node list
-        reply_api_init_data = controller.request(message.request_SerialApiGetInitData(), 'reply_SerialApiGetInitData')
-        if reply_api_init_data == None:
+    def _set_replies(self, replies):
+        if len(replies) < len(ControllerDetails.REQUESTS) or None in replies:
             logging.error("The device is busy or is not a Z-Wave controller")
             raise DeviceNotAvailable
+        reply_api_init_data, reply_version, reply_ids, reply_api_capabilities = replies
 
+        # Serial api init data, node list
         self.is_primary = reply_api_init_data.is_primary
         self.is_SIS = reply_api_init_data.is_SIS
         self.chip = reply_api_init_data.chip
-        self.nodes = reply_api_init_data.nodes
+        self.nodes = bits.NodeBitmap.from_bytes(reply_api_init_data.nodes)
 
-        # Get type and version
-        reply_version = controller.request(message.request_GetVersion(), 'reply_GetVersion')
+        # Type and version
         self.type = reply_version.library_type
         self.version = reply_version.version
 
-        # Get home id and node id
-        reply_ids = controller.request(message.request_MemoryGetId(), 'reply_MemoryGetId')
+        # Home id and node id
         self.home_id = reply_ids.home_id
         self.node_id = reply_ids.node_id
 
-        # Get serial api version and ids; supported functions
-        reply_api_capabilities = controller.request(message.request_SerialApiGetCapabilities(), 'reply_SerialApiGetCapabilities')
+        # Serial api version and ids; supported functions
         self.serial_api_version = reply_api_capabilities.serial_api_version
         self.manufacturer = reply_api_capabilities.manufacturer
         self.manufacturer_id = reply_api_capabilities.manufacturer_id
         self.product_type = reply_api_capabilities.product_type
         self.product_id = reply_api_capabilities.product_id
-        self.funcid_supported = reply_api_capabilities.funcid_supported
+        self.funcid_supported = bits.NodeBitmap.from_bytes(reply_api_capabilities.funcid_supported)
 
     def log(self):
         logging.info("--- controller --")
@@ -55,5 +127,5 @@ class ControllerDetails:
         logging.info("manufacturer id     %s" % self.manufacturer_id)
         logging.info("product type        %s" % self.product_type)
         logging.info("product id          %s" % self.product_id)
-        logging.info("read NVM supported  %s" % bits.is_id_set(self.funcid_supported, message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]))
-        logging.info("write NVM supported %s" % bits.is_id_set(self.funcid_supported, message.FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0]))
+        logging.info("read NVM supported  %s" % (message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0] in self.funcid_supported))
+        logging.info("write NVM supported %s" % (message.FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0] in self.funcid_supported))
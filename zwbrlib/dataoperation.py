@@ -1,13 +1,42 @@
+import logging
+import time
+
 from zwbrlib.progress import ProgressBar
+import zwbrlib.message as message
+
+def block_ranges(block_size, nvm_offset = 0, nvm_size = None):
+    """ Offset and length of each block of a part of the NVM (the first nvm_size bytes by
+    default); the last block may be shorter """
+    end = nvm_offset + (nvm_size or DataOperation.nvm_size)
+    return [(offset, min(block_size, end - offset)) for offset in range(nvm_offset, end, block_size)]
 
 class DataOperation:
 
-    # Part of the NVM to read/write
+    # Part of the NVM to read/write by default (first bytes)
+    nvm_size = 6144
+
+    # Default size of a transfer (used when no size has been negotiated)
     block_size = 128
-    block_count = 48
 
-    def __init__(self, operation_name):
-        self._progress = ProgressBar(DataOperation.block_count, prefix = operation_name, suffix = "complete")
+    # Retries of a read returning less data than requested
+    read_retries = 3
+
+    def __init__(self, operation_name, controller, block_size = None, region = None):
+        """ region is the part of the NVM handled (offset and size), the first nvm_size bytes by default """
+        self._operation_name = operation_name.strip().lower()
+        self._controller = controller
+        self.block_size = block_size or DataOperation.block_size
+        self.nvm_offset, self.nvm_size = region or (0, DataOperation.nvm_size)
+        self.block_count = -(-self.nvm_size // self.block_size)
+        logging.debug("%s: %d blocks of %d bytes" % (operation_name.strip(), self.block_count, self.block_size))
+        self._progress = ProgressBar(self.block_count, prefix = operation_name, suffix = "complete")
+
+    def started(self):
+        self._start = time.monotonic()
+
+    def done(self, size, blocks):
+        """ Records the throughput of the operation """
+        self._controller.metrics.operation(self._operation_name, size, blocks, time.monotonic() - self._start)
 
     def progress(self, iteration):
         self._progress.print(iteration)
@@ -16,4 +45,39 @@ class DataOperation:
         self._progress.done()
 
     def getExpectedSize(self):
-        return DataOperation.block_size * DataOperation.block_count
+        return self.nvm_size
+
+    def block_range(self, count):
+        """ Returns the offset (in the NVM) and the length of a block; the last block may be shorter """
+        offset = count * self.block_size
+        return self.nvm_offset + offset, min(self.block_size, self.nvm_size - offset)
+
+    def _read_block(self, count):
+        """ Returns the data of a block or None on failure.
+        A reply shorter than requested is never returned, the read is retried. """
+        offset, length = self.block_range(count)
+        for i in range(DataOperation.read_retries):
+            reply_read = self._controller.request(message.request_ReadNVM(offset, length), 'reply_ReadNVM')
+            if reply_read == None:
+                return None
+            if len(reply_read.data) == length:
+                return reply_read.data
+            logging.warning("Read NVM at %d: %d bytes received, %d expected" % (offset, len(reply_read.data), length))
+        return None
+
+    def _write_block(self, count, data):
+        """ Returns True when the block has been written """
+        request = self._write_request(count, data)
+        return request != None and self._send_write(request)
+
+    def _write_request(self, count, data):
+        """ Returns the request writing a block or None if the data does not fill the block """
+        offset, length = self.block_range(count)
+        if len(data) != length:
+            return None
+        return message.request_WriteNVM(offset, data)
+
+    def _send_write(self, request):
+        """ Returns True when the write request succeeded """
+        reply_write = self._controller.request(request, 'reply_WriteNVM')
+        return reply_write != None and reply_write.success
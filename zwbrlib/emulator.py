@@ -0,0 +1,257 @@
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+from argparse import ArgumentParser
+
+from zwbrlib.bits import NodeBitmap as NodeBitmap
+import zwbrlib.message as message
+from zwbrlib.message import Frame as Frame
+from zwbrlib.transport import FrameParser as FrameParser
+
+# Function id of the notification of an application command (unsolicited)
+FUNC_ID_APPLICATION_COMMAND_HANDLER = bytes([0x04])
+
+class Faults:
+    """ Faults injected by the emulator; rates are probabilities per frame """
+
+    def __init__(self, latency = 0, nak = 0, can = 0, corrupt = 0, drop = 0, unsolicited = 0, burst = 5, seed = None):
+        # Delay before each response (seconds)
+        self.latency = latency
+        # Request answered by a NAK or a CAN instead of an ACK
+        self.nak = nak
+        self.can = can
+        # Response sent with an invalid checksum
+        self.corrupt = corrupt
+        # Response sent with a missing byte
+        self.drop = drop
+        # Burst of unsolicited frames sent before a response
+        self.unsolicited = unsolicited
+        self.burst = burst
+        self.random = random.Random(seed)
+
+    def happens(self, rate):
+        return rate > 0 and self.random.random() < rate
+
+class Node:
+    """ Protocol info of an emulated node """
+
+    def __init__(self, capabilities = 0xD3, security = 0x1C, basic = 0x04, generic = 0x10, specific = 0x01):
+        self.info = bytes([capabilities, security, 0x00, basic, generic, specific])
+
+class ControllerEmulator:
+    """ Z-Wave controller emulated behind a pseudo-terminal (Linux/MacOS).
+    Implements the functions of the serial API used by zwbr on an in-memory NVM. """
+
+    def __init__(self, nvm_size = 16384, home_id = 0xC0FFEE01, nodes = None, faults = None,
+                 max_transfer = message.NVM_DATA_MAX_LENGTH, chip = (0x05, 0x00), seed = 0):
+        # Distinct bytes: a block read or written at a wrong offset is detected
+        rng = random.Random(seed)
+        self.nvm = bytearray(rng.getrandbits(8) for i in range(nvm_size))
+        self.home_id = home_id
+        self.node_id = 1
+        self.nodes = nodes if nodes != None else {1: Node(basic = 0x02, generic = 0x02, specific = 0x07), 2: Node()}
+        self.faults = faults or Faults()
+        self.max_transfer = max_transfer
+        self.chip = chip
+        # Duration of a soft reset (seconds)
+        self.reset_time = 0.05
+        # Received requests and injected faults, by name
+        self.stats = dict()
+        self._parser = FrameParser()
+        self._last_sent = None
+        self._lock = threading.Lock()
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        tty.setraw(self._master)
+        self.device = os.ttyname(self._slave)
+        self._running = False
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target = self._serve, name = "zwbr-emulator", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread != None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _count(self, name):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+    def _serve(self):
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                self._parser.drop_incomplete()
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            self._parser.feed(data)
+            for frame in self._parser.frames():
+                self._handle(frame)
+
+    def _handle(self, frame: Frame):
+        if frame is message.discarded:
+            self._count('discarded')
+            self._write(message.FRAME_NAK)
+            return
+        if frame.is_ack():
+            self._last_sent = None
+            return
+        if frame.is_nak():
+            # Retransmission of the last data frame
+            if self._last_sent != None:
+                self._count('retransmitted')
+                self._send(self._last_sent)
+            return
+        if not frame.is_data():
+            return
+
+        if self.faults.happens(self.faults.nak):
+            self._count('nak')
+            self._write(message.FRAME_NAK)
+            return
+        if self.faults.happens(self.faults.can):
+            self._count('can')
+            self._write(message.FRAME_CAN)
+            return
+        self._write(message.FRAME_ACK)
+
+        handler = ControllerEmulator.HANDLERS.get(frame.get_func_id())
+        if handler == None:
+            self._count('unsupported')
+            return
+        self._count(handler.__name__[1:])
+        if self.faults.latency > 0:
+            time.sleep(self.faults.latency)
+        if self.faults.happens(self.faults.unsolicited):
+            self._count('unsolicited')
+            for i in range(self.faults.burst):
+                self._send(message._data(message.TYPE_REQ + FUNC_ID_APPLICATION_COMMAND_HANDLER + bytes([0x00, 0x02, 0x03, 0x31, 0x05, 0x01])), False)
+        handler(self, frame.frame[4:-1])
+
+    def _response(self, func_id: bytes, payload: bytes):
+        self._send(message._data(message.TYPE_RES + func_id + payload))
+
+    def _callback(self, func_id: bytes, payload: bytes):
+        self._send(message._data(message.TYPE_REQ + func_id + payload))
+
+    def _send(self, data: bytes, faulty = True):
+        self._last_sent = data
+        if faulty and self.faults.happens(self.faults.corrupt):
+            self._count('corrupted')
+            data = data[:-1] + bytes([data[-1] ^ 0xFF])
+        elif faulty and self.faults.happens(self.faults.drop):
+            self._count('dropped')
+            position = self.faults.random.randrange(2, len(data))
+            data = data[:position] + data[position + 1:]
+        self._write(data)
+
+    def _write(self, data: bytes):
+        with self._lock:
+            os.write(self._master, data)
+
+    # Serial API functions; args are the bytes following the function id
+
+    def _get_init_data(self, args):
+        bitmap = NodeBitmap.from_ids(self.nodes).to_bytes(29)
+        self._response(message.FUNC_ID_SERIAL_API_GET_INIT_DATA, bytes([0x05, 0x08, 29]) + bitmap + bytes(self.chip))
+
+    def _get_capabilities(self, args):
+        supported = NodeBitmap.from_ids(ControllerEmulator.HANDLERS).to_bytes(32)
+        self._response(message.FUNC_ID_SERIAL_API_GET_CAPABILITIES, bytes([0x01, 0x02, 0x00, 0x86, 0x00, 0x01, 0x00, 0x5A]) + supported)
+
+    def _soft_reset(self, args):
+        time.sleep(self.reset_time)
+        self._callback(message.FUNC_ID_SERIAL_API_STARTED, bytes([0x00, 0x00, 0x01, 0x02, 0x07, 0x00]))
+
+    def _get_version(self, args):
+        self._response(message.FUNC_ID_ZW_GET_VERSION, b'Z-Wave 4.54\0' + bytes([0x01]))
+
+    def _memory_get_id(self, args):
+        self._response(message.FUNC_ID_ZW_MEMORY_GET_ID, struct.pack(">IB", self.home_id, self.node_id))
+
+    def _nvm_get_id(self, args):
+        self._response(message.FUNC_ID_NVM_GET_ID, bytes([0x1F, 0x20, len(self.nvm).bit_length() - 1]))
+
+    def _read_nvm(self, args):
+        offset, length = _decode_NVM_op_args(args)
+        length = min(length, self.max_transfer)
+        self._response(message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER, bytes(self.nvm[offset:offset + length]))
+
+    def _write_nvm(self, args):
+        offset, length = _decode_NVM_op_args(args)
+        data = args[5:5 + length]
+        if length > self.max_transfer or len(data) != length or offset + length > len(self.nvm):
+            self._response(message.FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER, bytes([0x00]))
+            return
+        self.nvm[offset:offset + length] = data
+        self._response(message.FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER, bytes([0x01]))
+
+    def _get_node_protocol_info(self, args):
+        node = self.nodes.get(args[0])
+        self._response(message.FUNC_ID_ZW_GET_NODE_PROTOCOL_INFO, node.info if node != None else bytes(6))
+
+    def _set_default(self, args):
+        self.nvm[:] = bytes([0xFF]) * len(self.nvm)
+        self.home_id = random.Random(self.home_id).getrandbits(32)
+        self.nodes = {1: Node(basic = 0x02, generic = 0x02, specific = 0x07)}
+        self._callback(message.FUNC_ID_ZW_SET_DEFAULT, args[0:1])
+
+    HANDLERS = {
+        message.FUNC_ID_SERIAL_API_GET_INIT_DATA[0]: _get_init_data,
+        message.FUNC_ID_SERIAL_API_GET_CAPABILITIES[0]: _get_capabilities,
+        message.FUNC_ID_SERIAL_API_SOFT_RESET[0]: _soft_reset,
+        message.FUNC_ID_ZW_GET_VERSION[0]: _get_version,
+        message.FUNC_ID_ZW_MEMORY_GET_ID[0]: _memory_get_id,
+        message.FUNC_ID_NVM_GET_ID[0]: _nvm_get_id,
+        message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]: _read_nvm,
+        message.FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0]: _write_nvm,
+        message.FUNC_ID_ZW_GET_NODE_PROTOCOL_INFO[0]: _get_node_protocol_info,
+        message.FUNC_ID_ZW_SET_DEFAULT[0]: _set_default,
+        }
+
+def _decode_NVM_op_args(args):
+    return int.from_bytes(args[0:3], 'big'), int.from_bytes(args[3:5], 'big')
+
+if __name__ == '__main__':
+    p = ArgumentParser(description="Z-Wave controller emulator (pseudo-terminal)")
+    p.add_argument('--latency', type=float, default=0, help="delay before each response (seconds)")
+    p.add_argument('--nak', type=float, default=0, help="rate of requests answered by a NAK")
+    p.add_argument('--can', type=float, default=0, help="rate of requests answered by a CAN")
+    p.add_argument('--corrupt', type=float, default=0, help="rate of responses with an invalid checksum")
+    p.add_argument('--drop', type=float, default=0, help="rate of responses with a missing byte")
+    p.add_argument('--unsolicited', type=float, default=0, help="rate of bursts of unsolicited frames")
+    p.add_argument('--burst', type=int, default=5, help="unsolicited frames per burst")
+    p.add_argument('--seed', type=int, help="seed of the injected faults")
+    p.add_argument('--nvm-size', dest="nvm_size", type=int, default=16384, help="size of the NVM (bytes, a power of 2)")
+    args = p.parse_args()
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    faults = Faults(args.latency, args.nak, args.can, args.corrupt, args.drop, args.unsolicited, args.burst, args.seed)
+    with ControllerEmulator(args.nvm_size, faults = faults) as emulator:
+        logging.info("Emulated controller on %s (Ctrl-C to stop)" % emulator.device)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        logging.info("Stats %s" % emulator.stats)
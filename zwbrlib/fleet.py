@@ -0,0 +1,122 @@
+import glob
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from zwbrlib.backup import ZwBackup
+import zwbrlib.imagefile as imagefile
+from zwbrlib.controller import Controller
+from zwbrlib.controllerdetails import ControllerDetails
+from zwbrlib.metrics import Metrics
+from zwbrlib.nvmlayout import nvm_region
+from zwbrlib.progress import ProgressBar
+from zwbrlib.repository import BackupRepository
+from zwbrlib.transfer import negotiate_block_size
+
+# Result of the backup of one controller
+FleetResult = namedtuple('FleetResult', ['device', 'home_id', 'file', 'duration', 'size', 'retries', 'error', 'metrics'])
+
+def expand_devices(patterns):
+    """ Devices of the patterns (like /dev/serial/by-id/*), without duplicates """
+    devices = list()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if len(matches) == 0:
+            logging.warning("No device matches '%s'" % pattern)
+        for device in matches:
+            if device not in devices:
+                devices.append(device)
+    return devices
+
+# Backup file names given by backup_file_name
+_file_names = set()
+_file_names_lock = threading.Lock()
+
+def backup_file_name(dest_dir, home_id):
+    """ Name of a new backup file: the home id, the date to the microsecond and, if needed,
+    a counter making it unique (controllers with the same home id, backups of the same second) """
+    now = time.time()
+    name = "%s-%s-%06d" % (home_id, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now % 1 * 1000000))
+    with _file_names_lock:
+        path = os.path.join(dest_dir, name + ".zwb")
+        count = 1
+        while path in _file_names or os.path.exists(path):
+            path = os.path.join(dest_dir, "%s-%d.zwb" % (name, count))
+            count += 1
+        _file_names.add(path)
+    return path
+
+class FleetBackup:
+    """ Backup of several controllers in parallel; each device has its own controller
+    and a failure only affects its device. """
+
+    def __init__(self, devices, dest_dir, jobs = None, block_size = None, retry_policy = None, metrics = False, format = None, repository_path = None,
+                 region = None):
+        """ retry_policy builds the retry policy of each controller; metrics enables the
+        collection of the protocol metrics of each controller; with repository_path, the
+        backups are recorded as snapshots of the repository (dest_dir is not used);
+        region is the name of the part of the NVM backed up (see nvmlayout.REGIONS) """
+        self._devices = devices
+        self._dest_dir = dest_dir
+        self._jobs = jobs or min(8, len(devices))
+        self._block_size = block_size
+        self._retry_policy = retry_policy or (lambda: None)
+        self._metrics = metrics
+        self._format = format
+        self._repository_path = repository_path
+        self._region = region
+
+    def exec(self):
+        """ Returns the results, in the order of the devices """
+        ProgressBar.enabled = False
+        try:
+            with ThreadPoolExecutor(max_workers = self._jobs, thread_name_prefix = "zwbr") as executor:
+                return list(executor.map(self._backup, self._devices))
+        finally:
+            ProgressBar.enabled = True
+
+    def _backup(self, device):
+        logging.info("%s: backup started" % device)
+        start = time.monotonic()
+        home_id = file = None
+        size = retries = 0
+        error = None
+        controller = None
+        metrics = Metrics(device = device) if self._metrics else None
+        try:
+            controller = Controller(device, self._retry_policy(), metrics)
+            controller_details = ControllerDetails(controller)
+            home_id = controller_details.home_id
+            block_size = self._block_size or negotiate_block_size(controller, controller_details)
+            region = nvm_region(controller, controller_details, self._region) if self._region != None else None
+            if self._repository_path != None:
+                with BackupRepository(self._repository_path) as repository:
+                    backup = ZwBackup(controller, None, block_size, controller_details, repository = repository, region = region)
+                    backup.exec()
+                file = "snapshot %d" % backup.snapshot_id
+                size = backup.getExpectedSize()
+            else:
+                file = backup_file_name(self._dest_dir, home_id)
+                ZwBackup(controller, file, block_size, controller_details, self._format or imagefile.FORMAT_VERSION,
+                         region = region).exec()
+                size = os.stat(file).st_size
+            logging.info("%s: backup done in '%s'" % (device, file))
+        except BaseException as e:
+            logging.error("%s: backup failed: %s" % (device, e))
+            error = str(e) or type(e).__name__
+            file = None
+        finally:
+            if controller != None:
+                retries = controller.retry_count
+                controller.close()
+        return FleetResult(device, home_id, file, time.monotonic() - start, size, retries, error, metrics)
+
+def log_summary(results):
+    logging.info("--- summary -----")
+    logging.info("%-30s %-8s %8s %6s %7s %s" % ("device", "home id", "duration", "bytes", "retries", "result"))
+    for result in results:
+        logging.info("%-30s %-8s %7.1fs %6d %7d %s" % (result.device, result.home_id or "?", result.duration,
+                                                        result.size, result.retries, result.error or result.file))
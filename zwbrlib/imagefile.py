@@ -0,0 +1,212 @@
+import os
+import struct
+import tempfile
+import zlib
+
+from zwbrlib.dataoperation import DataOperation as DtOp
+import zwbrlib.message as message
+
+# Version 2 file: header, index (CRC32 of each block), then the blocks.
+# Version 3 file: version 2 with the offset of the part in the NVM (part not starting at 0).
+# Version 1 file: raw NVM part, without header.
+MAGIC = b'ZWBRNVM\x00'
+FORMAT_VERSION = 2
+FORMAT_REGION = 3
+# magic, format version, header size, home id, chip, firmware version, block size, block count, data size, header CRC
+HEADER = struct.Struct('<8sHH4s8s32sIIII')
+# Same with the NVM offset before the header CRC
+HEADER_REGION = struct.Struct('<8sHH4s8s32sIIIII')
+INDEX_ENTRY = struct.Struct('<I')
+NVM_MAX_SIZE = message.NVM_OFFSET_LIMIT
+
+class InvalidImage(Exception):
+    pass
+
+class ImageInfo:
+    """ Description of a backup file """
+
+    def __init__(self, format, home_id, chip, version, block_size, block_count, size, crcs, data_offset, offset = 0):
+        self.format = format
+        self.home_id = home_id
+        self.chip = chip
+        self.version = version
+        self.block_size = block_size
+        self.block_count = block_count
+        self.size = size
+        self.crcs = crcs
+        self.data_offset = data_offset
+        # Offset of the part in the NVM
+        self.offset = offset
+
+    @property
+    def region(self):
+        return self.offset, self.size
+
+    def block_range(self, index):
+        """ Offset (in the part) and length of a block """
+        offset = index * self.block_size
+        return offset, min(self.block_size, self.size - offset)
+
+def read_info(f) -> ImageInfo:
+    """ Reads the header and the index of an opened backup file """
+    f.seek(0)
+    header = f.read(HEADER.size)
+    if not header.startswith(MAGIC):
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size != DtOp.nvm_size:
+            raise InvalidImage("Invalid file (wrong size)")
+        return ImageInfo(1, None, None, None, DtOp.nvm_size, 1, file_size, None, 0)
+
+    if len(header) < HEADER.size:
+        raise InvalidImage("Truncated header")
+    format = HEADER.unpack(header)[1]
+    if format == FORMAT_VERSION:
+        magic, format, header_size, home_id, chip, version, block_size, block_count, size, header_crc = HEADER.unpack(header)
+        offset = 0
+    elif format == FORMAT_REGION:
+        header += f.read(HEADER_REGION.size - HEADER.size)
+        if len(header) < HEADER_REGION.size:
+            raise InvalidImage("Truncated header")
+        magic, format, header_size, home_id, chip, version, block_size, block_count, size, offset, header_crc = HEADER_REGION.unpack(header)
+    else:
+        raise InvalidImage("Unsupported format %d" % format)
+    if block_size == 0 or size == 0 or block_count != -(-size // block_size) or offset + size > NVM_MAX_SIZE:
+        raise InvalidImage("Invalid block layout")
+    index = f.read(INDEX_ENTRY.size * block_count)
+    if len(index) < INDEX_ENTRY.size * block_count:
+        raise InvalidImage("Truncated index")
+    if zlib.crc32(index, zlib.crc32(header[:-INDEX_ENTRY.size])) != header_crc:
+        raise InvalidImage("Invalid header (CRC)")
+    crcs = [crc for crc, in INDEX_ENTRY.iter_unpack(index)]
+    return ImageInfo(format, home_id.hex().upper(), _decode_text(chip), _decode_text(version),
+                     block_size, block_count, size, crcs, header_size + len(index), offset)
+
+def read_block(f, info: ImageInfo, index):
+    """ Reads and verifies a block (version 2) or reads the whole NVM part (version 1) """
+    offset, length = info.block_range(index)
+    f.seek(info.data_offset + offset)
+    data = f.read(length)
+    if len(data) != length:
+        raise InvalidImage("Truncated block %d" % index)
+    if info.crcs != None and zlib.crc32(data) != info.crcs[index]:
+        raise InvalidImage("Invalid block %d (CRC)" % index)
+    return data
+
+def verify(f):
+    """ Returns the indexes of the invalid blocks """
+    info = read_info(f)
+    invalid = list()
+    for index in range(info.block_count):
+        try:
+            read_block(f, info, index)
+        except InvalidImage:
+            invalid.append(index)
+    return invalid
+
+def load(f):
+    """ Reads the NVM part of a backup file; all the blocks are verified """
+    info = read_info(f)
+    return info, b''.join(read_block(f, info, index) for index in range(info.block_count))
+
+class ImageWriter:
+    """ Writes a backup file: written to a temporary file, synced, then renamed.
+    The blocks must be written in order; the destination file must not exist.
+    The blocks are streamed to the file, only their CRCs are kept in memory.
+    A part of the NVM not starting at 0 (region) is written in format 3. """
+
+    def __init__(self, path, home_id = None, chip = None, version = None, block_size = DtOp.block_size, format = FORMAT_VERSION,
+                 region = None):
+        if os.path.exists(path):
+            raise FileExistsError("File '%s' exists" % path)
+        self._offset, self._size = region or (0, DtOp.nvm_size)
+        if format == 1 and (self._offset, self._size) != (0, DtOp.nvm_size):
+            raise ValueError("Format 1 only holds the first %d bytes of the NVM" % DtOp.nvm_size)
+        if format == FORMAT_VERSION and self._offset != 0:
+            format = FORMAT_REGION
+        self._path = path
+        self._format = format
+        self._header = HEADER_REGION if format == FORMAT_REGION else HEADER
+        self._block_size = block_size
+        self._block_count = -(-self._size // block_size)
+        self._crcs = list()
+        self._home_id = bytes.fromhex(home_id) if home_id else bytes(4)
+        self._chip = chip
+        self._version = version
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, self._temp_path = tempfile.mkstemp(prefix = '.' + os.path.basename(path), suffix = '.tmp', dir = directory)
+        self._file = os.fdopen(descriptor, 'w+b')
+        if format != 1:
+            # Header and index written on commit
+            self._file.write(bytes(self._header.size + INDEX_ENTRY.size * self._block_count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # The temporary file is left only by a commit not done (error or not called)
+        self.abort()
+
+    def write_block(self, data):
+        if len(self._crcs) >= self._block_count:
+            raise InvalidImage("Too many blocks")
+        self._crcs.append(zlib.crc32(data))
+        self._file.write(data)
+
+    def commit(self):
+        """ Completes the file and renames it to its destination """
+        if len(self._crcs) != self._block_count:
+            raise InvalidImage("Missing blocks (%d/%d)" % (len(self._crcs), self._block_count))
+        if self._format != 1:
+            index = b''.join(INDEX_ENTRY.pack(crc) for crc in self._crcs)
+            fields = [MAGIC, self._format, self._header.size, self._home_id, _encode_text(self._chip, 8),
+                      _encode_text(self._version, 32), self._block_size, self._block_count, self._size]
+            if self._format == FORMAT_REGION:
+                fields.append(self._offset)
+            header = self._header.pack(*fields, 0)
+            header_crc = zlib.crc32(index, zlib.crc32(header[:-INDEX_ENTRY.size]))
+            self._file.seek(0)
+            self._file.write(header[:-INDEX_ENTRY.size] + INDEX_ENTRY.pack(header_crc) + index)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        # The link fails if the destination exists, even if created by a concurrent backup
+        try:
+            os.link(self._temp_path, self._path)
+        except FileExistsError:
+            self.abort()
+            raise FileExistsError("File '%s' exists" % self._path)
+        except OSError:
+            # No hard links (like FAT file systems)
+            if os.path.exists(self._path):
+                self.abort()
+                raise FileExistsError("File '%s' exists" % self._path)
+            os.replace(self._temp_path, self._path)
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+        _fsync_directory(os.path.dirname(os.path.abspath(self._path)))
+
+    def abort(self):
+        """ Removes the temporary file (the destination is not touched) """
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+def _encode_text(text, size):
+    return (text or '').encode('utf-8')[:size].ljust(size, b'\0')
+
+def _decode_text(data):
+    return data.rstrip(b'\0').decode('utf-8', 'replace') or None
+
+def _fsync_directory(directory):
+    """ Makes the rename durable (not available on Windows) """
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
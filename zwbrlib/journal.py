@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+
+# Suffix of the journal of a backup file
+JOURNAL_SUFFIX = '.journal'
+
+class Journal:
+    """ Sidecar journal of the blocks completed by an operation: a JSON header line, then a line
+    per block with its index, its SHA-256 and, when kept, its data (hexadecimal).
+    The lines are flushed one by one: an interrupted operation is resumed from the first block
+    missing in its journal. A journal without path is kept in memory only. """
+
+    def __init__(self, path, header, resume = False):
+        """ The entries of an existing journal are kept on resume if its header is the same """
+        self.path = path
+        self.header = header
+        self._blocks = dict()
+        self._file = None
+        if path == None:
+            return
+        if resume:
+            self._load()
+        self._rewrite()
+
+    def _rewrite(self):
+        """ Writes the header and the valid entries """
+        self.close()
+        self._file = open(self.path, 'w')
+        self._file.write(json.dumps(self.header, sort_keys = True) + '\n')
+        for index in sorted(self._blocks):
+            self._write(index, *self._blocks[index])
+        self._file.flush()
+
+    def reset(self):
+        """ Forgets the completed blocks """
+        self._blocks = dict()
+        if self.path != None:
+            self._rewrite()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return
+        try:
+            if json.loads(lines[0]) != self.header:
+                logging.warning("Journal '%s' of another operation, not resumed" % self.path)
+                return
+        except ValueError:
+            return
+        for line in lines[1:]:
+            fields = line.split(' ')
+            try:
+                index, digest = int(fields[0]), fields[1]
+                data = bytes.fromhex(fields[2]) if len(fields) > 2 else None
+            except (ValueError, IndexError):
+                # Line interrupted while written
+                break
+            if data != None and hashlib.sha256(data).hexdigest() != digest:
+                logging.warning("Journal '%s': invalid block %d" % (self.path, index))
+                break
+            self._blocks[index] = (digest, data)
+
+    def completed(self):
+        """ Number of the blocks completed from the first one """
+        count = 0
+        while count in self._blocks:
+            count += 1
+        return count
+
+    def digest(self, index):
+        return self._blocks[index][0] if index in self._blocks else None
+
+    def data(self, index):
+        """ Data of a block loaded from the journal on resume (None if not kept) """
+        return self._blocks[index][1] if index in self._blocks else None
+
+    def record(self, index, data, keep_data = False):
+        """ Records a completed block; its data is kept in the file only (read back on resume) """
+        digest = hashlib.sha256(data).hexdigest()
+        self._blocks[index] = (digest, None)
+        if self._file != None:
+            self._write(index, digest, data if keep_data else None)
+            self._file.flush()
+
+    def _write(self, index, digest, data):
+        self._file.write("%d %s%s\n" % (index, digest, " " + data.hex() if data != None else ""))
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """ Removes the journal of a completed operation """
+        self.close()
+        if self.path != None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+def image_digest(image):
+    return hashlib.sha256(image).hexdigest()
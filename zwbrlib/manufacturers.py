@@ -0,0 +1,52 @@
+import threading
+
+from zwbrlib.resources import MANUFACTURERS_FILE
+
+# Manufacturer name when the id is not found
+UNKNOWN = '?'
+
+_lock = threading.Lock()
+_path = MANUFACTURERS_FILE
+_manufacturers = None
+
+def use_file(path):
+    """ Uses another manufacturer list (CSV file with the columns ID and Manufacturer) """
+    global _path, _manufacturers
+    with _lock:
+        _path = path
+        _manufacturers = None
+
+def manufacturers():
+    """ Manufacturer names by numeric id, loaded once """
+    global _manufacturers
+    with _lock:
+        if _manufacturers == None:
+            _manufacturers = _load(_path)
+        return _manufacturers
+
+def lookup(manufacturer_id):
+    """ Name of a manufacturer; the id is a number or a string like '0x0086' """
+    return manufacturers().get(_to_int(manufacturer_id), UNKNOWN)
+
+def lookup_many(manufacturer_ids):
+    """ Names of the manufacturers by id """
+    names = manufacturers()
+    return {manufacturer_id: names.get(_to_int(manufacturer_id), UNKNOWN) for manufacturer_id in manufacturer_ids}
+
+def _to_int(manufacturer_id):
+    if isinstance(manufacturer_id, str):
+        try:
+            return int(manufacturer_id, 16)
+        except ValueError:
+            return None
+    return manufacturer_id
+
+def _load(path):
+    import csv
+    names = dict()
+    with open(path, newline='') as manufacturers_file:
+        for row in csv.DictReader(manufacturers_file):
+            manufacturer_id = _to_int(row['ID'])
+            if manufacturer_id != None:
+                names.setdefault(manufacturer_id, row['Manufacturer'])
+    return names
@@ -23,8 +23,10 @@ TYPE_RES = bytes([0x01])  # Response
 FUNC_ID_SERIAL_API_GET_INIT_DATA    = bytes([0x02]) # node list
 FUNC_ID_SERIAL_API_GET_CAPABILITIES = bytes([0x07]) # version, details, list functions
 FUNC_ID_SERIAL_API_SOFT_RESET       = bytes([0x08]) # soft reset the controller; no reply expected
+FUNC_ID_SERIAL_API_STARTED          = bytes([0x0A]) # notification: serial API ready (after a reset)
 FUNC_ID_ZW_GET_VERSION              = bytes([0x15])
 FUNC_ID_ZW_MEMORY_GET_ID            = bytes([0x20]) # get homeid, nodeid
+FUNC_ID_NVM_GET_ID                  = bytes([0x29]) # NVM manufacturer, type and size (2^capacity code)
 FUNC_ID_NVM_EXT_READ_LONG_BUFFER    = bytes([0x2A]) # read NVM offset (3? bytes) - len (2? byte)
 FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER   = bytes([0x2B]) # write NVM offset (3? bytes) - len (2? byte) - data (len bytes)
 FUNC_ID_ZW_GET_NODE_PROTOCOL_INFO   = bytes([0x41]) # get node type
@@ -36,6 +38,8 @@ FUNC_ID_ZW_SET_DEFAULT_CB_ID        = bytes([0x12])
 
 class Frame:
 
+    __slots__ = ('frame',)
+
     def __init__(self, frame: bytes):
         # bytes of the frame
         self.frame = frame
@@ -63,16 +67,16 @@ class Frame:
         return self.frame[3]
 
     def reply_SerialApiGetInitData(self):
-        return self._response(FUNC_ID_SERIAL_API_GET_INIT_DATA[0], "SERIAL_API_GET_INIT_DATA", 'ReplySerialApiGetGetInitData')
+        return self._response(FUNC_ID_SERIAL_API_GET_INIT_DATA[0])
 
     def reply_SerialApiGetCapabilities(self):
-        return self._response(FUNC_ID_SERIAL_API_GET_CAPABILITIES[0], "SERIAL_API_GET_CAPABILITIES", 'ReplySerialApiGetCapabilities')
+        return self._response(FUNC_ID_SERIAL_API_GET_CAPABILITIES[0])
 
     def reply_GetVersion(self):
-        return self._response(FUNC_ID_ZW_GET_VERSION[0], "GET_VERSION", 'ReplyGetVersion')
+        return self._response(FUNC_ID_ZW_GET_VERSION[0])
 
     def reply_MemoryGetId(self):
-        return self._response(FUNC_ID_ZW_MEMORY_GET_ID[0], "MEMORY_GET_ID", 'ReplyMemoryGetId')
+        return self._response(FUNC_ID_ZW_MEMORY_GET_ID[0])
 
     def reply_SetDefault(self):
         if not self.is_data() or not self.is_request() or self.get_func_id() != FUNC_ID_ZW_SET_DEFAULT[0] or self.frame[4] != FUNC_ID_ZW_SET_DEFAULT_CB_ID[0]:
@@ -89,22 +93,43 @@ class Frame:
             # existing node
             return Node(self.frame, node_id)
 
+    def reply_NVMGetId(self):
+        return self._response(FUNC_ID_NVM_GET_ID[0])
+
     def reply_ReadNVM(self):
-        return self._response(FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0], "NVM_READ", 'ReplyReadNVM')
+        return self._response(FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0])
 
     def reply_WriteNVM(self):
-        return self._response(FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0], "NVM_WRITE", 'ReplyWriteNVM')
+        return self._response(FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0])
 
-    def _response(self, expected_func_id, func_name, reply_name):
-        if not self.is_data() or not self.is_response() or self.get_func_id() != expected_func_id:
-            logging.warn("Not a %s response" % func_name)
+    def _response(self, expected_func_id):
+        frame = self.frame
+        if frame[0] != FRAME_SOF[0] or frame[2] != TYPE_RES[0] or frame[3] != expected_func_id:
+            logging.warning("Not a %s response" % REPLY_PARSERS[expected_func_id][0])
             return
-        reply_builder = getattr(reply, reply_name)
-        return reply_builder(self.frame)
+        return REPLY_PARSERS[expected_func_id][1](frame)
+
+# Parsers of the responses, by function id: function name and reply class
+REPLY_PARSERS = {
+    FUNC_ID_SERIAL_API_GET_INIT_DATA[0]: ("SERIAL_API_GET_INIT_DATA", reply.ReplySerialApiGetGetInitData),
+    FUNC_ID_SERIAL_API_GET_CAPABILITIES[0]: ("SERIAL_API_GET_CAPABILITIES", reply.ReplySerialApiGetCapabilities),
+    FUNC_ID_ZW_GET_VERSION[0]: ("GET_VERSION", reply.ReplyGetVersion),
+    FUNC_ID_ZW_MEMORY_GET_ID[0]: ("MEMORY_GET_ID", reply.ReplyMemoryGetId),
+    FUNC_ID_NVM_GET_ID[0]: ("NVM_GET_ID", reply.ReplyNVMGetId),
+    FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]: ("NVM_READ", reply.ReplyReadNVM),
+    FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0]: ("NVM_WRITE", reply.ReplyWriteNVM),
+    }
 
 class PayloadTooLargeError(Exception):
     pass
 
+# Maximum length of a data frame (length byte)
+FRAME_MAX_LENGTH = 252
+# Maximum data length of a NVM write: type, function id, offset (3 bytes) and length (2 bytes)
+NVM_DATA_MAX_LENGTH = FRAME_MAX_LENGTH - 8
+# NVM offsets are 3 bytes long
+NVM_OFFSET_LIMIT = 1 << 24
+
 # Immutable utility frames
 ack = Frame(FRAME_ACK)
 nak = Frame(FRAME_NAK)
@@ -113,47 +138,78 @@ discarded = Frame(FRAME_DISCARDED)
 none = Frame(FRAME_NONE)
 
 def compute_checksum(length, payload: bytes):
-    checksum = 0xFF ^ length
-    for i in range(0, length - 1):
-        checksum ^= payload[i]
-    return checksum
+    """ Checksum of a data frame: 0xFF xor the length and the payload bytes (length - 1 bytes).
+    The bytes are xored as one integer folded in halves, not one by one. """
+    value = int.from_bytes(payload[:length - 1], 'little')
+    size = length - 1
+    while size > 1:
+        size = (size + 1) // 2
+        value = (value >> (size * 8)) ^ (value & ((1 << (size * 8)) - 1))
+    return 0xFF ^ length ^ value
+
+def _data(payload: bytes):
+    length = len(payload) + 1
+    if length > FRAME_MAX_LENGTH:
+        raise PayloadTooLargeError
+    checksum = compute_checksum(length, payload)
+    return FRAME_SOF + bytes([length]) + payload + bytes([checksum])
+
+def _request_void(funcid):
+    return Frame(_data(TYPE_REQ + funcid))
+
+# Requests without parameters, built once (frames are immutable)
+_REQUEST_GET_INIT_DATA = _request_void(FUNC_ID_SERIAL_API_GET_INIT_DATA)
+_REQUEST_GET_CAPABILITIES = _request_void(FUNC_ID_SERIAL_API_GET_CAPABILITIES)
+_REQUEST_SOFT_RESET = _request_void(FUNC_ID_SERIAL_API_SOFT_RESET)
+_REQUEST_GET_VERSION = _request_void(FUNC_ID_ZW_GET_VERSION)
+_REQUEST_MEMORY_GET_ID = _request_void(FUNC_ID_ZW_MEMORY_GET_ID)
+_REQUEST_NVM_GET_ID = _request_void(FUNC_ID_NVM_GET_ID)
+_REQUEST_SET_DEFAULT = Frame(_data(TYPE_REQ + FUNC_ID_ZW_SET_DEFAULT + FUNC_ID_ZW_SET_DEFAULT_CB_ID))
 
 def request_SerialApiGetInitData():
-    return _request_void(FUNC_ID_SERIAL_API_GET_INIT_DATA)
+    return _REQUEST_GET_INIT_DATA
 
 def request_SerialApiGetCapabilities():
-    return _request_void(FUNC_ID_SERIAL_API_GET_CAPABILITIES)
+    return _REQUEST_GET_CAPABILITIES
 
 def request_SoftReset():
-    return _request_void(FUNC_ID_SERIAL_API_SOFT_RESET)
+    return _REQUEST_SOFT_RESET
 
 def request_GetVersion():
-    return _request_void(FUNC_ID_ZW_GET_VERSION)
+    return _REQUEST_GET_VERSION
 
 def request_MemoryGetId():
-    return _request_void(FUNC_ID_ZW_MEMORY_GET_ID)
+    return _REQUEST_MEMORY_GET_ID
 
-def _request_void(funcid):
-    return Frame(_data(TYPE_REQ + funcid))
+def request_NVMGetId():
+    return _REQUEST_NVM_GET_ID
 
 def request_SetDefault():
-    return Frame(_data(TYPE_REQ + FUNC_ID_ZW_SET_DEFAULT + FUNC_ID_ZW_SET_DEFAULT_CB_ID))
+    return _REQUEST_SET_DEFAULT
 
 def request_GetNodeProtocolInfo(node_id):
     return Frame(_data(TYPE_REQ + FUNC_ID_ZW_GET_NODE_PROTOCOL_INFO + bytes([node_id])))
 
+# NVM request header: SOF, length, type, function id, offset (3 bytes, big endian), data length
+_NVM_HEADER = struct.Struct(">BBBBBHH")
+# Bytes of the header counted by the length
+_NVM_HEADER_LENGTH = _NVM_HEADER.size - 2
+
 def request_ReadNVM(offset, len):
-    return Frame(_data(TYPE_REQ + FUNC_ID_NVM_EXT_READ_LONG_BUFFER + _encode_NVM_op_args(offset, len)))
+    return Frame(_encode_NVM_request(FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0], offset, len, b''))
 
 def request_WriteNVM(offset, data_to_write: bytes):
-    return Frame(_data(TYPE_REQ + FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER + _encode_NVM_op_args(offset, len(data_to_write)) + data_to_write))
-
-def _encode_NVM_op_args(offset, len):
-    return struct.pack(">I", offset)[1:5] + bytes([0, len])
-
-def _data(payload: bytes):
-    length = len(payload) + 1
-    if length > 252:
+    return Frame(_encode_NVM_request(FUNC_ID_NVM_EXT_WRITE_LONG_BUFFER[0], offset, len(data_to_write), data_to_write))
+
+def _encode_NVM_request(func_id, offset, data_length, data: bytes):
+    """ Encodes the frame in a buffer allocated once at its final size """
+    if offset < 0 or offset >= NVM_OFFSET_LIMIT:
+        raise ValueError("NVM offset %d out of range" % offset)
+    length = _NVM_HEADER_LENGTH + len(data) + 1
+    if length > FRAME_MAX_LENGTH:
         raise PayloadTooLargeError
-    checksum = compute_checksum(length, payload)
-    return FRAME_SOF + bytes([length]) + payload + bytes([checksum])
+    frame = bytearray(length + 2)
+    _NVM_HEADER.pack_into(frame, 0, FRAME_SOF[0], length, TYPE_REQ[0], func_id, offset >> 16, offset & 0xFFFF, data_length)
+    frame[_NVM_HEADER.size:_NVM_HEADER.size + len(data)] = data
+    frame[-1] = compute_checksum(length, memoryview(frame)[2:])
+    return frame
@@ -0,0 +1,155 @@
+import bisect
+import json
+import threading
+
+class Histogram:
+    """ Cumulative histogram of durations (seconds) """
+
+    # Upper bounds of the buckets (seconds)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(Histogram.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = dict()
+        for bound, count in zip(Histogram.BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+class Metrics:
+    """ Protocol metrics of a controller.
+    Counters by name and function id (None when not related to a function), latency
+    histograms by function id and throughput of the backup/restore operations. """
+
+    def __init__(self, **labels):
+        # Labels of the exported metrics (like device)
+        self.labels = labels
+        self.counters = dict()
+        self.latencies = dict()
+        self.operations = dict()
+        self._lock = threading.Lock()
+
+    def count(self, name, func_id = None, value = 1):
+        key = (name, func_id)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe_latency(self, func_id, seconds):
+        with self._lock:
+            histogram = self.latencies.get(func_id)
+            if histogram == None:
+                histogram = self.latencies[func_id] = Histogram()
+            histogram.observe(seconds)
+
+    def operation(self, name, size, blocks, seconds):
+        """ Throughput of a backup/restore """
+        with self._lock:
+            self.operations[name] = {'bytes': size, 'blocks': blocks, 'seconds': seconds,
+                                     'bytes_per_second': size / seconds if seconds > 0 else 0}
+
+    def get(self, name, func_id = None):
+        return self.counters.get((name, func_id), 0)
+
+    def total(self, name):
+        """ Counter summed over the function ids """
+        return sum(value for (counter, func_id), value in self.counters.items() if counter == name)
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict()
+            for (name, func_id), value in sorted(self.counters.items(), key = lambda item: (item[0][0], item[0][1] or 0)):
+                counters.setdefault(name, dict())[_func_label(func_id)] = value
+            return {
+                'labels': self.labels,
+                'counters': counters,
+                'latency_seconds': {_func_label(func_id): histogram.to_dict() for func_id, histogram in sorted(self.latencies.items())},
+                'operations': dict(self.operations),
+                }
+
+    def prometheus_lines(self):
+        lines = list()
+        with self._lock:
+            for (name, func_id), value in sorted(self.counters.items(), key = lambda item: (item[0][0], item[0][1] or 0)):
+                labels = dict(self.labels)
+                if func_id != None:
+                    labels['func'] = _func_label(func_id)
+                lines.append(('zwbr_%s_total' % name, 'counter', labels, value))
+            for func_id, histogram in sorted(self.latencies.items()):
+                labels = dict(self.labels, func = _func_label(func_id))
+                for bound, count in histogram.to_dict()['buckets'].items():
+                    lines.append(('zwbr_request_duration_seconds_bucket', 'histogram', dict(labels, le = bound), count))
+                lines.append(('zwbr_request_duration_seconds_sum', 'histogram', labels, histogram.sum))
+                lines.append(('zwbr_request_duration_seconds_count', 'histogram', labels, histogram.count))
+            for name, operation in sorted(self.operations.items()):
+                for key, value in operation.items():
+                    lines.append(('zwbr_operation_%s' % key, 'gauge', dict(self.labels, operation = name), value))
+        return lines
+
+class NoMetrics:
+    """ Disabled metrics: nothing is collected """
+
+    labels = dict()
+
+    def count(self, name, func_id = None, value = 1):
+        pass
+
+    def observe_latency(self, func_id, seconds):
+        pass
+
+    def operation(self, name, size, blocks, seconds):
+        pass
+
+    def get(self, name, func_id = None):
+        return 0
+
+    def total(self, name):
+        return 0
+
+    def to_dict(self):
+        return dict()
+
+    def prometheus_lines(self):
+        return list()
+
+no_metrics = NoMetrics()
+
+def _func_label(func_id):
+    return "0x%02x" % func_id if func_id != None else "all"
+
+def to_prometheus(metrics_list):
+    """ Prometheus text format of the metrics """
+    families = dict()
+    for metrics in metrics_list:
+        for name, type, labels, value in metrics.prometheus_lines():
+            family = name
+            if type == 'histogram':
+                for suffix in ('_bucket', '_sum', '_count'):
+                    if family.endswith(suffix):
+                        family = family[:-len(suffix)]
+            families.setdefault((family, type), list()).append((name, labels, value))
+
+    text = list()
+    for (family, type), lines in families.items():
+        text.append("# TYPE %s %s" % (family, type))
+        for name, labels, value in lines:
+            label_text = ",".join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels.items())
+            text.append("%s{%s} %s" % (name, label_text, value) if label_text else "%s %s" % (name, value))
+    return "\n".join(text) + "\n"
+
+def write(path, metrics_list):
+    """ Writes the metrics: JSON when the file name ends with .json, Prometheus text format otherwise """
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump([metrics.to_dict() for metrics in metrics_list], f, indent = 1)
+        else:
+            f.write(to_prometheus(metrics_list))
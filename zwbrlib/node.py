@@ -1,45 +1,97 @@
-import xml.etree.ElementTree as ET
 import logging
+import marshal
+import os
+import tempfile
 
-tree = ET.parse('open-zwave-device_classes.xml')
-device_classes = tree.getroot()
+import zwbrlib.cache as cache
+from zwbrlib.resources import DEVICE_CLASSES_FILE
 
 DEVICE_CLASS_NAME_BASIC = '{https://github.com/OpenZWave/open-zwave}Basic'
 DEVICE_CLASS_NAME_GENERIC = '{https://github.com/OpenZWave/open-zwave}Generic'
 DEVICE_CLASS_NAME_SPECIFIC = '{https://github.com/OpenZWave/open-zwave}Specific'
 
-def _find_class_basic(basic_id):
-    class_ = _find_class(DEVICE_CLASS_NAME_BASIC, basic_id)
-    if class_ != None:
-        return class_.get('label')
-    return "Unknown"
-
-def _find_class_generic(generic_id):
-    class_ = _find_class(DEVICE_CLASS_NAME_GENERIC, generic_id)
-    if class_ != None:
-        return class_.get('label')
-    return "Unknown"
-
-def _find_class_specific(generic_id, specific_id):
-    class_ = _find_class(DEVICE_CLASS_NAME_GENERIC, generic_id)
-    if class_ != None:
-        subclass_ = _find_class_in_subtree(class_, DEVICE_CLASS_NAME_SPECIFIC, specific_id)
-        if subclass_ != None:
-            return subclass_.get('label')
-    return "Unknown"
-
-def _find_class(name, id):
-    return _find_class_in_subtree(device_classes, name, id)
-
-def _find_class_in_subtree(start, name, id):
-    for class_ in start.findall(name):
-        if int(class_.get('key'), 16) == id:
-            return class_
+# Version of the precompiled index (to change with its content)
+INDEX_VERSION = 1
+INDEX_CACHE_NAME = 'device_classes.marshal'
+
+class DeviceClassIndex:
+    """ Labels of the device classes by id; the specific classes by (generic id << 8 | specific id) """
+
+    def __init__(self, basic, generic, specific):
+        self.basic = basic
+        self.generic = generic
+        self.specific = specific
+
+    def find_class_basic(self, basic_id):
+        return self.basic.get(basic_id, "Unknown")
+
+    def find_class_generic(self, generic_id):
+        return self.generic.get(generic_id, "Unknown")
+
+    def find_class_specific(self, generic_id, specific_id):
+        return self.specific.get(generic_id << 8 | specific_id, "Unknown")
+
+_device_classes = None
+
+def device_classes() -> DeviceClassIndex:
+    """ Index of the device classes, loaded on first use """
+    global _device_classes
+    if _device_classes == None:
+        _device_classes = load_index(DEVICE_CLASSES_FILE, cache.cache_path(INDEX_CACHE_NAME))
+    return _device_classes
+
+def load_index(xml_path, cache_path) -> DeviceClassIndex:
+    """ Loads the precompiled index or builds it from the XML file.
+    The precompiled index is rebuilt when the XML file changes (size or modification time). """
+    stat = os.stat(xml_path)
+    signature = (INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = marshal.load(f)
+        if cached[0] == signature:
+            return DeviceClassIndex(*cached[1:])
+    except (OSError, EOFError, ValueError, TypeError, IndexError):
+        pass
+
+    index = _parse_index(xml_path)
+    temp = None
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        # A temporary file per writer (parallel runs)
+        fd, temp = tempfile.mkstemp(prefix = os.path.basename(cache_path) + '.', suffix = '.tmp', dir = os.path.dirname(cache_path))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((signature, index.basic, index.generic, index.specific), f)
+        os.replace(temp, cache_path)
+    except OSError as e:
+        logging.debug("Device classes index not saved: %s" % e)
+        if temp != None and os.path.exists(temp):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+    return index
+
+def _parse_index(xml_path) -> DeviceClassIndex:
+    import xml.etree.ElementTree as ET
+    root = ET.parse(xml_path).getroot()
+    basic = dict()
+    generic = dict()
+    specific = dict()
+    for class_ in root.findall(DEVICE_CLASS_NAME_BASIC):
+        basic.setdefault(int(class_.get('key'), 16), class_.get('label'))
+    for class_ in root.findall(DEVICE_CLASS_NAME_GENERIC):
+        generic_id = int(class_.get('key'), 16)
+        generic.setdefault(generic_id, class_.get('label'))
+        for subclass_ in class_.findall(DEVICE_CLASS_NAME_SPECIFIC):
+            specific.setdefault(generic_id << 8 | int(subclass_.get('key'), 16), subclass_.get('label'))
+    return DeviceClassIndex(basic, generic, specific)
 
 class Node:
 
     def __init__(self, frame: bytes, node_id):
         self.node_id = node_id
+        # Protocol info bytes (cached)
+        self.info = bytes(frame[4:10])
 
         capabilities = frame[4]
         security = frame[5]
@@ -62,9 +114,15 @@ class Node:
         self.sensor_250ms = (security & 0x20) != 0
         self.sensor_1000ms = (security & 0x40) != 0
 
-        self.class_basic = _find_class_basic(class_basic)
-        self.class_generic = _find_class_generic(class_generic)
-        self.class_specific = _find_class_specific(class_generic, class_specific)
+        classes = device_classes()
+        self.class_basic = classes.find_class_basic(class_basic)
+        self.class_generic = classes.find_class_generic(class_generic)
+        self.class_specific = classes.find_class_specific(class_generic, class_specific)
+
+    @classmethod
+    def from_info(cls, info: bytes, node_id):
+        """ Node of protocol info bytes (GET_NODE_PROTOCOL_INFO reply payload or NVM record) """
+        return cls(bytes(4) + bytes(info), node_id)
 
     def log(self):
         logging.info("%03d basic class    %s" % (self.node_id, self.class_basic))
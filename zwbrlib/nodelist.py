@@ -1,25 +1,130 @@
 import logging
+import time
 
-import zwbrlib.bits as bits
+import zwbrlib.cache as cache
 from zwbrlib.controller import Controller as Controller
 from zwbrlib.controllerdetails import ControllerDetails as ControllerDetails
 import zwbrlib.message as message
+from zwbrlib.node import Node as Node
+from zwbrlib.progress import ProgressBar
+
+CACHE_NAME = 'nodes'
 
 def get_node(controller: Controller, node_id):
     return controller.request(message.request_GetNodeProtocolInfo(node_id), 'reply_GetNodeProtocolInfo', node_id)
 
+def node_ids_to_query(controller_details: ControllerDetails, full_scan):
+    """ Ids of the nodes of the controller or all the ids """
+    if full_scan:
+        return list(range(1, 234))
+    return list(controller_details.nodes)
+
+class NodeScan:
+    """ Scan of node ids.
+    Each request has a short deadline; an absent node (valid reply) is not retried, the ids
+    whose request failed are retried in the next passes with the default deadline."""
+
+    # Deadline and attempts of a request during the first pass (seconds)
+    timeout = 0.3
+    retries = 2
+    # Passes over the failed ids, after the first one
+    retry_passes = 2
+
+    def __init__(self, controller: Controller, node_ids):
+        self._controller = controller
+        self._node_ids = node_ids
+        self.nodes = list()
+        self.absent = list()
+        self.failed = list()
+
+    def exec(self):
+        """ Returns the nodes found, by id """
+        start = time.monotonic()
+        progress = ProgressBar(len(self._node_ids), prefix = "Scan   ", suffix = "complete")
+        self.failed = list()
+        found = dict()
+        for count, node_id in enumerate(self._node_ids):
+            self._scan(node_id, NodeScan.retries, NodeScan.timeout, found)
+            progress.print(count + 1)
+
+        for scan_pass in range(NodeScan.retry_passes):
+            if len(self.failed) == 0:
+                break
+            logging.info("Scan again %d id(s): %s" % (len(self.failed), self.failed))
+            node_ids = self.failed
+            self.failed = list()
+            for node_id in node_ids:
+                self._scan(node_id, None, None, found)
+
+        self.nodes = [found[node_id] for node_id in sorted(found)]
+        duration = time.monotonic() - start
+        logging.info("%d id(s) scanned in %.1fs (%.1f ids/s): %d node(s), %d absent, %d failed" % (
+            len(self._node_ids), duration, len(self._node_ids) / max(duration, 0.001),
+            len(self.nodes), len(self.absent), len(self.failed)))
+        if len(self.failed) > 0:
+            logging.warning("Scan failed for id(s) %s" % self.failed)
+        return self.nodes
+
+    def _scan(self, node_id, retries, timeout, found):
+        reply_frame = self._controller.get_reply_frame(message.request_GetNodeProtocolInfo(node_id), retries, timeout)
+        if reply_frame == None:
+            self.failed.append(node_id)
+            return
+        node = reply_frame.reply_GetNodeProtocolInfo(node_id)
+        if node != None:
+            found[node_id] = node
+        else:
+            self.absent.append(node_id)
+
 class NodeList:
 
+    # Protocol info of the nodes kept in the cache directory by home id: only the nodes added
+    # since the last run are queried; False queries all the nodes (they are still cached)
+    use_cache = True
+
     def __init__(self, controller: Controller, controller_details: ControllerDetails, full_scan):
         """ List the nodes of the controller """
         logging.info("")
         self.nodes = list()
-        nodes_ids = controller_details.nodes
-        for node_id in range(1, 234):
-            if full_scan or bits.is_id_set(nodes_ids, node_id):
-                node = get_node(controller, node_id)
-                if node != None:
-                    self.nodes.append(node)
+        node_ids = node_ids_to_query(controller_details, full_scan)
+        if full_scan:
+            self.nodes = NodeScan(controller, node_ids).exec()
+        else:
+            cached = NodeList._load(controller_details.home_id) if NodeList.use_cache else dict()
+            found = dict((node_id, Node.from_info(cached[node_id], node_id)) for node_id in node_ids if node_id in cached)
+            missing = [node_id for node_id in node_ids if node_id not in found]
+            if len(found) > 0:
+                logging.debug("%d cached node(s), %d to query" % (len(found), len(missing)))
+            if len(missing) > 0:
+                for node_id in missing:
+                    node = get_node(controller, node_id)
+                    if node != None:
+                        found[node_id] = node
+            self.nodes = [found[node_id] for node_id in sorted(found)]
+        NodeList._save(controller_details.home_id, self.nodes)
+
+    @staticmethod
+    def _load(home_id):
+        """ Cached protocol info of the nodes of a network, by node id """
+        try:
+            return dict((int(node_id), bytes.fromhex(info)) for node_id, info in cache.load(CACHE_NAME).get(home_id, {}).items())
+        except (AttributeError, TypeError, ValueError):
+            return dict()
+
+    @staticmethod
+    def _save(home_id, nodes):
+        """ The removed nodes are dropped """
+        content = dict((str(node.node_id), node.info.hex()) for node in nodes)
+        cached = cache.load(CACHE_NAME)
+        if cached.get(home_id) != content:
+            cached[home_id] = content
+            cache.save(CACHE_NAME, cached)
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        node_list = cls.__new__(cls)
+        node_list.nodes = list(nodes)
+        return node_list
 
     def log(self):
         logging.info("--- nodes -------")
@@ -0,0 +1,61 @@
+import logging
+
+from zwbrlib.controller import Controller as Controller
+from zwbrlib.dataoperation import DataOperation as DtOp
+import zwbrlib.imagefile as imagefile
+import zwbrlib.message as message
+
+# Smallest NVM of the chips, used when the controller does not report the size of its NVM
+NVM_SIZES = {
+    "ZW050x": 16384,
+    }
+
+# Named parts of the NVM: offset and size (None up to the end of the NVM)
+REGIONS = {
+    # Part handled by the first versions of zwbr
+    'base': (0, DtOp.nvm_size),
+    'extended': (DtOp.nvm_size, None),
+    'all': (0, None),
+    }
+
+def nvm_get_id_supported(controller_details):
+    return message.FUNC_ID_NVM_GET_ID[0] in controller_details.funcid_supported
+
+def detect_nvm_size(controller: Controller, controller_details):
+    """ Size of the NVM: reported by NVM_GET_ID when supported, from the chip otherwise;
+    None if unknown """
+    reply_id = None
+    if nvm_get_id_supported(controller_details):
+        reply_id = controller.request(message.request_NVMGetId(), 'reply_NVMGetId')
+    return nvm_size_of(reply_id, controller_details)
+
+def nvm_size_of(reply_id, controller_details):
+    """ Size of the NVM from the NVM_GET_ID reply (None if not available), from the chip otherwise """
+    if reply_id != None:
+        if reply_id.size > imagefile.NVM_MAX_SIZE:
+            logging.warning("NVM size %d bytes not supported (offsets of 3 bytes)" % reply_id.size)
+        elif reply_id.size >= DtOp.nvm_size:
+            logging.info("NVM size %d bytes (type 0x%02X, manufacturer 0x%02X)" % (reply_id.size, reply_id.memory_type, reply_id.manufacturer_id))
+            return reply_id.size
+    size = NVM_SIZES.get(controller_details.chip)
+    if size != None:
+        logging.info("NVM size %d bytes (chip %s)" % (size, controller_details.chip))
+    return size
+
+def region_range(name, nvm_size):
+    """ Offset and size of a named part of the NVM; 'all' is the base part when the NVM size is unknown """
+    offset, size = REGIONS[name]
+    if size == None:
+        if nvm_size == None and offset == 0:
+            logging.warning("NVM size unknown, only the first %d bytes are handled" % DtOp.nvm_size)
+            return REGIONS['base']
+        if nvm_size == None:
+            raise ValueError("NVM size unknown, region '%s' not available" % name)
+        size = nvm_size - offset
+    if size <= 0 or (nvm_size != None and offset + size > nvm_size):
+        raise ValueError("Region '%s' beyond the NVM (%d bytes)" % (name, nvm_size))
+    return offset, size
+
+def nvm_region(controller: Controller, controller_details, name):
+    """ Offset and size of a named part of the NVM of the controller """
+    return region_range(name, detect_nvm_size(controller, controller_details))
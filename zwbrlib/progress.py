@@ -4,6 +4,9 @@ import sys
 class ProgressBar:
     """ Print or log progress."""
 
+    # Disabled when several operations run concurrently
+    enabled = True
+
     def __init__(self, total, prefix = "", suffix = "", length = 50, fill = '█'):
         self._log = not sys.stdout.isatty()
         self._total = total
@@ -17,6 +20,8 @@ class ProgressBar:
 
     def print(self, iteration):
         """ Progressing. """
+        if not ProgressBar.enabled:
+            return
         if self._log:
             logging.info("%s %3d%% %s" % (self._prefix, 100 * iteration // self._total, self._suffix))
         else:
@@ -30,5 +35,5 @@ class ProgressBar:
 
     def done(self):
         """ New line to end progress. """
-        if not self._log:
+        if ProgressBar.enabled and not self._log:
             print()
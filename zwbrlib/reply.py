@@ -1,5 +1,7 @@
 import logging
-import csv
+import struct
+
+import zwbrlib.manufacturers as manufacturers
 
 class NotAController(Exception):
     pass
@@ -46,13 +48,7 @@ class ReplySerialApiGetCapabilities:
         logging.debug("func id=%s (len=%d)" % (self.funcid_supported.hex(), len(self.funcid_supported)))
 
         # Look for manufacturer name
-        self.manufacturer = '?'
-        with open('manufacturers-2020-07-01.csv', newline='') as manufacturers:
-            reader = csv.DictReader(manufacturers)
-            for row in reader:
-                if row['ID'] == self.manufacturer_id:
-                    self.manufacturer = row['Manufacturer']
-                    break
+        self.manufacturer = manufacturers.lookup(frame[6] << 8 | frame[7])
 
 class ReplyGetVersion:
 
@@ -74,9 +70,21 @@ class ReplyGetVersion:
 
 class ReplyMemoryGetId:
 
+    # Home id (big endian) and node id
+    PAYLOAD = struct.Struct(">IB")
+
+    def __init__(self, frame: bytes):
+        home_id, self.node_id = ReplyMemoryGetId.PAYLOAD.unpack_from(frame, 4)
+        self.home_id = "%08X" % home_id
+
+class ReplyNVMGetId:
+
     def __init__(self, frame: bytes):
-        self.home_id = "%02X%02X%02X%02X" % (frame[4], frame[5], frame[6], frame[7])
-        self.node_id = frame[8]
+        self.manufacturer_id = frame[4]
+        self.memory_type = frame[5]
+        # Size of the NVM: 2^capacity code bytes
+        self.capacity_code = frame[6]
+        self.size = 1 << frame[6]
 
 class ReplySetDefault:
 
@@ -92,4 +100,4 @@ class ReplyReadNVM:
 class ReplyWriteNVM:
 
     def __init__(self, frame: bytes):
-        pass
+        self.success = frame[4] != 0
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+from zwbrlib.dataoperation import DataOperation as DtOp
+import zwbrlib.imagefile as imagefile
+
+# Size of the blocks stored (independent of the transfer size)
+BLOCK_SIZE = 128
+
+CATALOG_FILE = 'catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    hash BLOB PRIMARY KEY,
+    data BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    home_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    chip TEXT,
+    version TEXT,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_home_id_created ON snapshots (home_id, created);
+CREATE TABLE IF NOT EXISTS snapshot_blocks (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id),
+    block_index INTEGER NOT NULL,
+    hash BLOB NOT NULL REFERENCES blocks (hash),
+    PRIMARY KEY (snapshot_id, block_index)
+) WITHOUT ROWID;
+"""
+
+class SnapshotNotFound(Exception):
+    pass
+
+class Snapshot:
+
+    def __init__(self, id, home_id, created, chip, version, size):
+        self.id = id
+        self.home_id = home_id
+        self.created = created
+        self.chip = chip
+        self.version = version
+        self.size = size
+
+    def log_line(self):
+        return "%6d %-8s %s %-8s %s" % (self.id, self.home_id, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.created)),
+                                        self.chip or "?", self.version or "?")
+
+class BackupRepository:
+    """ Repository of backups: the NVM blocks are stored once by hash (SHA-256) and each
+    snapshot is recorded in a catalog indexed by home id and time. The storage grows with
+    the changes, not with the number of snapshots. """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok = True)
+        self._db = sqlite3.connect(os.path.join(path, CATALOG_FILE), timeout = 30)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_snapshot(self, image, home_id, chip = None, version = None, created = None):
+        """ Records a snapshot of the NVM image; returns its id """
+        with self._db:
+            cursor = self._db.execute("INSERT INTO snapshots (home_id, created, chip, version, size) VALUES (?, ?, ?, ?, ?)",
+                                      (home_id, created or time.time(), chip, version, len(image)))
+            snapshot_id = cursor.lastrowid
+            rows = list()
+            for index, offset in enumerate(range(0, len(image), BLOCK_SIZE)):
+                data = bytes(image[offset:offset + BLOCK_SIZE])
+                digest = hashlib.sha256(data).digest()
+                self._db.execute("INSERT OR IGNORE INTO blocks (hash, data) VALUES (?, ?)", (digest, data))
+                rows.append((snapshot_id, index, digest))
+            self._db.executemany("INSERT INTO snapshot_blocks (snapshot_id, block_index, hash) VALUES (?, ?, ?)", rows)
+        return snapshot_id
+
+    def snapshots(self, home_id = None):
+        """ Snapshots, the oldest first """
+        if home_id != None:
+            cursor = self._db.execute("SELECT id, home_id, created, chip, version, size FROM snapshots WHERE home_id = ? ORDER BY created, id", (home_id,))
+        else:
+            cursor = self._db.execute("SELECT id, home_id, created, chip, version, size FROM snapshots ORDER BY home_id, created, id")
+        return [Snapshot(*row) for row in cursor]
+
+    def latest(self, home_id):
+        row = self._db.execute("SELECT id, home_id, created, chip, version, size FROM snapshots WHERE home_id = ? ORDER BY created DESC, id DESC LIMIT 1", (home_id,)).fetchone()
+        return Snapshot(*row) if row != None else None
+
+    def snapshot(self, snapshot_id):
+        row = self._db.execute("SELECT id, home_id, created, chip, version, size FROM snapshots WHERE id = ?", (snapshot_id,)).fetchone()
+        if row == None:
+            raise SnapshotNotFound("Snapshot %s not found" % snapshot_id)
+        return Snapshot(*row)
+
+    def block_hashes(self, snapshot_id):
+        self.snapshot(snapshot_id)
+        cursor = self._db.execute("SELECT hash FROM snapshot_blocks WHERE snapshot_id = ? ORDER BY block_index", (snapshot_id,))
+        return [row[0] for row in cursor]
+
+    def diff(self, first_id, second_id):
+        """ Indexes of the blocks that differ between two snapshots, with their NVM offset """
+        first = self.block_hashes(first_id)
+        second = self.block_hashes(second_id)
+        count = max(len(first), len(second))
+        first += [None] * (count - len(first))
+        second += [None] * (count - len(second))
+        return [(index, index * BLOCK_SIZE) for index in range(count) if first[index] != second[index]]
+
+    def image(self, snapshot_id):
+        """ NVM image of a snapshot """
+        snapshot = self.snapshot(snapshot_id)
+        cursor = self._db.execute("SELECT blocks.data FROM snapshot_blocks JOIN blocks ON blocks.hash = snapshot_blocks.hash "
+                                  "WHERE snapshot_id = ? ORDER BY block_index", (snapshot_id,))
+        image = b''.join(row[0] for row in cursor)
+        if len(image) != snapshot.size:
+            raise SnapshotNotFound("Snapshot %s incomplete" % snapshot_id)
+        return image
+
+    def export(self, snapshot_id, path, format = imagefile.FORMAT_VERSION):
+        """ Writes a snapshot as a restorable backup file """
+        snapshot = self.snapshot(snapshot_id)
+        image = self.image(snapshot_id)
+        with imagefile.ImageWriter(path, snapshot.home_id, snapshot.chip, snapshot.version, BLOCK_SIZE, format, (0, len(image))) as writer:
+            for offset in range(0, len(image), BLOCK_SIZE):
+                writer.write_block(image[offset:offset + BLOCK_SIZE])
+            writer.commit()
+
+class RepositoryWriter:
+    """ Destination of a backup recording a snapshot in a repository (like imagefile.ImageWriter) """
+
+    def __init__(self, repository: BackupRepository, home_id, chip = None, version = None, size = DtOp.nvm_size):
+        self._repository = repository
+        self._size = size
+        self._home_id = home_id
+        self._chip = chip
+        self._version = version
+        self._image = bytearray()
+        self.snapshot_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def write_block(self, data):
+        self._image += data
+
+    def commit(self):
+        if len(self._image) != self._size:
+            raise imagefile.InvalidImage("Wrong size %d <> %d" % (len(self._image), self._size))
+        self.snapshot_id = self._repository.add_snapshot(self._image, self._home_id, self._chip, self._version)
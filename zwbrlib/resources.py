@@ -0,0 +1,10 @@
+import os
+
+# Directory of the reference data files (next to the package)
+RESOURCES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def resource_path(name):
+    return os.path.join(RESOURCES_DIR, name)
+
+MANUFACTURERS_FILE = resource_path('manufacturers-2020-07-01.csv')
+DEVICE_CLASSES_FILE = resource_path('open-zwave-device_classes.xml')
@@ -1,11 +1,18 @@
+import hashlib
 import logging
 import os
+import time
 from random import SystemRandom as SystemRandom
 
 from zwbrlib.controller import Controller as Controller
 from zwbrlib.controllerdetails import ControllerDetails as ControllerDetails
 from zwbrlib.dataoperation import DataOperation as DtOp
+import zwbrlib.cache as cache
+import zwbrlib.imagefile as imagefile
+from zwbrlib.journal import Journal as Journal
+from zwbrlib.journal import image_digest as journal_image_digest
 import zwbrlib.message as message
+import zwbrlib.nvmlayout as nvmlayout
 
 class RestorationFailed(Exception):
     pass
@@ -13,18 +20,42 @@ class RestorationFailed(Exception):
 class RestorationCancelled(Exception):
     pass
 
+def journal_path(controller: Controller):
+    """ Journal of the restoration of a controller, in the cache directory """
+    directory = cache.cache_dir()
+    os.makedirs(directory, exist_ok = True)
+    return os.path.join(directory, "restore-%s.journal" % hashlib.sha1(controller.identity().encode()).hexdigest()[:16])
+
 class ZwRestoration(DtOp):
 
-    def __init__(self, controller: Controller, controller_details: ControllerDetails, file):
-        super().__init__("Restore")
+    # Number of write/read back passes for the blocks that differ (differential mode)
+    verify_passes = 3
 
-        # Verify file size
-        if os.fstat(file.fileno()).st_size != self.getExpectedSize():
-            raise RestorationFailed("Invalid source file (wrong size)")
+    def __init__(self, controller: Controller, controller_details: ControllerDetails, file, differential = False, block_size = None, resume = False):
+        """ resume continues an interrupted full restoration of the same file (journal in the cache directory).
+        The part of the NVM restored is the one of the file. """
+        # Verify the file (size, header and blocks)
+        try:
+            info, self._image = imagefile.load(file)
+        except imagefile.InvalidImage as e:
+            raise RestorationFailed("Invalid source file (%s)" % e)
+        super().__init__("Restore", controller, block_size, info.region)
+        # The reset of a full restoration blanks the whole NVM
+        if info.offset != 0 and not differential:
+            raise RestorationFailed("The file holds a part of the NVM at %d: only a differential restoration is available" % info.offset)
+        # Checked before the reset: a larger image would leave the controller half written
+        nvm_size = nvmlayout.detect_nvm_size(controller, controller_details)
+        if nvm_size == None and info.offset + info.size > DtOp.nvm_size:
+            raise RestorationFailed("NVM size of the controller unknown: only the first %d bytes can be restored" % DtOp.nvm_size)
+        if nvm_size != None and info.offset + info.size > nvm_size:
+            raise RestorationFailed("The file ends at %d, beyond the NVM of the controller (%d bytes)" % (info.offset + info.size, nvm_size))
+        if info.home_id != None:
+            logging.info("Backup of home id %s (chip %s, version %s)" % (info.home_id, info.chip, info.version))
 
-        self._controller = controller
         self._controller_details = controller_details
         self._file = file
+        self._differential = differential
+        self._resume = resume
         self._success = False
 
     def exec(self):
@@ -32,25 +63,125 @@ class ZwRestoration(DtOp):
         self._confirm_restore()
         logging.info("--- restoring ---")
 
-        # Hard reset of the controller
-        reply_set_default = self._controller.request(message.request_SetDefault(), 'reply_SetDefault')
-        if reply_set_default == None:
-            raise RestorationFailed("Failed to reset controller")
-
-        for count in range(0, DtOp.block_count):
-            to_write = self._file.read(DtOp.block_size)
-            reply_write = self._controller.request(message.request_WriteNVM(count * DtOp.block_size, to_write), 'reply_WriteNVM')
-            if reply_write == None:
-                self.progressDone()
-                raise RestorationFailed("Write NVM failed")
-            
-            self.progress(count + 1)
+        # The details of the controller change with its NVM
+        self._controller_details.forget()
+        self.started()
+        self._written_blocks = 0
+        self._written_size = 0
+        if self._differential:
+            self._restore_differential()
+        else:
+            self._restore_full()
 
         self._success = True
+        self.done(self._written_size, self._written_blocks)
 
         # Soft reset the controller to take the new NVM into account
         self._controller.soft_reset()
 
+    def _restore_full(self):
+        """ Resets the controller and writes all the blocks.
+        The write requests are encoded before the reset: once reset, the controller only waits
+        for the requests sent back to back.
+        The blocks written are recorded in a journal; a resumed restoration reads back the
+        blocks of the journal and continues without reset when they all match. """
+        header = {'operation': 'restore', 'image': journal_image_digest(self._image), 'block_size': self.block_size,
+                  'offset': self.nvm_offset}
+        journal = Journal(journal_path(self._controller), header, self._resume)
+        try:
+            self._restore_full_journal(journal)
+        finally:
+            journal.close()
+        journal.remove()
+
+    def _restore_full_journal(self, journal: Journal):
+        start = journal.completed()
+        if start > 0:
+            differing = [count for count in range(0, start)
+                         if hashlib.sha256(self._read_block_or_fail(count)).hexdigest() != journal.digest(count)]
+            if len(differing) == 0:
+                logging.info("Restoration resumed at block %d" % start)
+            else:
+                logging.warning("Block(s) %s differ from the journal, restoration started again" % differing)
+                start = 0
+                journal.reset()
+
+        requests = list()
+        for count in range(0, self.block_count):
+            try:
+                request = self._write_request(count, self._image_block(count))
+            except message.PayloadTooLargeError:
+                request = None
+            if request == None:
+                raise RestorationFailed("Invalid block %d (size %d)" % (count, self.block_size))
+            requests.append(request)
+
+        # Hard reset of the controller
+        if start == 0:
+            reply_set_default = self._controller.request(message.request_SetDefault(), 'reply_SetDefault')
+            if reply_set_default == None:
+                raise RestorationFailed("Failed to reset controller")
+        reset_time = time.monotonic()
+
+        for count in range(start, self.block_count):
+            self._send_write_or_fail(requests[count], self.block_range(count)[1])
+            journal.record(count, self._image_block(count))
+            self.progress(count + 1)
+        logging.info("Blank NVM during %.1fs" % (time.monotonic() - reset_time))
+
+    def _restore_differential(self):
+        """ Writes only the blocks that differ from the source file, then reads them
+        back and writes again the ones that still differ.
+        The controller is not reset: the blocks already matching are left untouched."""
+        image = [self._image_block(count) for count in range(0, self.block_count)]
+
+        to_write = list()
+        for count in range(0, self.block_count):
+            if self._read_block_or_fail(count) != image[count]:
+                to_write.append(count)
+            self.progress(count + 1)
+        logging.info("%d block(s) of %d differ" % (len(to_write), self.block_count))
+
+        for verify_pass in range(ZwRestoration.verify_passes):
+            if len(to_write) == 0:
+                break
+            for count in to_write:
+                self._write_block_or_fail(count, image[count])
+            # Read back the written blocks
+            to_write = [count for count in to_write if self._read_block_or_fail(count) != image[count]]
+            if len(to_write) > 0:
+                logging.warning("%d block(s) differ after write: %s" % (len(to_write), to_write))
+
+        if len(to_write) > 0:
+            raise RestorationFailed("Verification failed for block(s) %s" % to_write)
+        logging.info("All blocks verified")
+
+    def _image_block(self, count):
+        offset, length = self.block_range(count)
+        offset -= self.nvm_offset
+        return self._image[offset:offset + length]
+
+    def _read_block_or_fail(self, count):
+        data = self._read_block(count)
+        if data == None:
+            self.progressDone()
+            raise RestorationFailed("Read NVM failed")
+        return data
+
+    def _write_block_or_fail(self, count, to_write):
+        request = self._write_request(count, to_write)
+        if request == None:
+            self.progressDone()
+            raise RestorationFailed("Write NVM failed")
+        self._send_write_or_fail(request, len(to_write))
+
+    def _send_write_or_fail(self, request, size):
+        if not self._send_write(request):
+            self.progressDone()
+            raise RestorationFailed("Write NVM failed")
+        self._written_blocks += 1
+        self._written_size += size
+
     def _confirm_restore(self):
         logging.info("")
         logging.info("+++++++++++++++++")
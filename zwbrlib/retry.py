@@ -0,0 +1,112 @@
+import zwbrlib.message as message
+
+class FunctionPolicy:
+    """ Retries and timeout of a function; None keeps the value of the policy """
+
+    def __init__(self, retries = None, timeout = None):
+        self.retries = retries
+        self.timeout = timeout
+
+    def merged(self, other):
+        """ Policy with the values of other, the ones of self where other has None """
+        return FunctionPolicy(other.retries if other.retries != None else self.retries,
+                              other.timeout if other.timeout != None else self.timeout)
+
+class RttEstimator:
+    """ Smoothed round-trip time and its variation (RFC 6298) """
+
+    # Gains of the smoothed RTT and of its variation
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self, initial_timeout):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_timeout
+
+    def observe(self, rtt, min_timeout, max_timeout):
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RttEstimator.beta) * self.rttvar + RttEstimator.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - RttEstimator.alpha) * self.srtt + RttEstimator.alpha * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, min_timeout), max_timeout)
+
+    def timed_out(self, max_timeout):
+        # Exponential backoff of the timeout
+        self.rto = min(self.rto * 2, max_timeout)
+
+class RetryPolicy:
+    """ Retries and timeouts of the requests.
+    The timeout of a function (wait of the ACK, then of the response) is estimated from the
+    measured round-trip times, unless it is fixed by an override. After a NAK or a CAN,
+    the request is sent again after an exponential backoff delay. """
+
+    # Default attempts of a request
+    retries = 20
+    # Timeout before any measure, bounds of the estimated timeout (seconds)
+    initial_timeout = 1.0
+    min_timeout = 0.2
+    max_timeout = 5.0
+    # Delay after a first NAK/CAN, doubled at each attempt up to backoff_max (seconds)
+    backoff_base = 0.01
+    backoff_max = 0.5
+
+    # Default overrides, by function id
+    OVERRIDES = {
+        # Reset of the controller: the callback may be slow
+        message.FUNC_ID_ZW_SET_DEFAULT[0]: FunctionPolicy(retries = 3, timeout = 10),
+        }
+
+    def __init__(self, retries = None, max_timeout = None, overrides = None):
+        """ retries is the number of attempts (0 or 1: a single attempt, no retry); the overrides
+        are merged with the default ones """
+        self.retries = max(retries, 1) if retries != None else RetryPolicy.retries
+        self.max_timeout = max_timeout or RetryPolicy.max_timeout
+        self.overrides = dict(RetryPolicy.OVERRIDES)
+        for func_id, override in (overrides or dict()).items():
+            self.overrides[func_id] = self.overrides.get(func_id, FunctionPolicy()).merged(override)
+        self._estimators = dict()
+
+    def budget(self, func_id):
+        """ Attempts and maximum time of a request """
+        retries = self.attempts(func_id)
+        override = self.overrides.get(func_id)
+        timeout = override.timeout if override != None and override.timeout != None else self.max_timeout
+        return retries, retries * 2 * timeout + sum(self.backoff(i) for i in range(retries))
+
+    def attempts(self, func_id):
+        override = self.overrides.get(func_id)
+        if override != None and override.retries != None:
+            return override.retries
+        return self.retries
+
+    def timeout(self, func_id):
+        override = self.overrides.get(func_id)
+        if override != None and override.timeout != None:
+            return override.timeout
+        return self._estimator(func_id).rto
+
+    def observe(self, func_id, rtt):
+        """ Round trip time of a request answered at its first transmission """
+        self._estimator(func_id).observe(rtt, RetryPolicy.min_timeout, self.max_timeout)
+
+    def timed_out(self, func_id):
+        self._estimator(func_id).timed_out(self.max_timeout)
+
+    def backoff(self, attempt):
+        """ Delay before sending again a request rejected (NAK/CAN) """
+        return min(RetryPolicy.backoff_base * (2 ** attempt), RetryPolicy.backoff_max)
+
+    def _estimator(self, func_id):
+        estimator = self._estimators.get(func_id)
+        if estimator == None:
+            estimator = RttEstimator(min(RetryPolicy.initial_timeout, self.max_timeout))
+            self._estimators[func_id] = estimator
+        return estimator
+
+def parse_function_timeout(text):
+    """ Parses an override like '0x42=10' (function id=timeout in seconds) """
+    func_id, timeout = text.split('=')
+    return int(func_id, 0), FunctionPolicy(timeout = float(timeout))
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from zwbrlib.asynccontroller import AsyncController, RequestFailed
+import zwbrlib.imagefile as imagefile
+import zwbrlib.message as message
+from zwbrlib.dataoperation import DataOperation
+from zwbrlib.emulator import ControllerEmulator, Faults, Node
+from zwbrlib.retry import RetryPolicy, FunctionPolicy
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+READ = message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]
+
+class TestAsyncController(unittest.IsolatedAsyncioTestCase):
+    """ Tests against an emulated controller, through asyncio streams on its pseudo-terminal """
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = self._directory.name
+        patch = mock.patch.dict(os.environ, {'ZWBR_CACHE_DIR': self.directory})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    async def open(self, emulator, retry_policy = None):
+        emulator.start()
+        self.addCleanup(emulator.stop)
+        loop = asyncio.get_running_loop()
+        fd = os.open(emulator.device, os.O_RDWR | os.O_NOCTTY)
+        reader = asyncio.StreamReader()
+        read_transport, protocol = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+        write_transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(os.dup(fd), 'wb', 0))
+        writer = asyncio.StreamWriter(write_transport, protocol, reader, loop)
+        controller = AsyncController(reader, writer, retry_policy)
+        self.addAsyncCleanup(controller.close)
+        self.addCleanup(read_transport.close)
+        return controller
+
+    def path(self):
+        return os.path.join(self.directory, "backup-%d" % len(os.listdir(self.directory)))
+
+    async def test_request(self):
+        controller = await self.open(ControllerEmulator())
+        reply_version = await controller.request(message.request_GetVersion(), 'reply_GetVersion')
+        self.assertEqual(reply_version.version, "Z-Wave 4.54")
+        node = await controller.request(message.request_GetNodeProtocolInfo(2), 'reply_GetNodeProtocolInfo', 2)
+        self.assertEqual(node.node_id, 2)
+
+    async def test_request_faults(self):
+        emulator = ControllerEmulator(faults = Faults(nak = 0.1, corrupt = 0.1, seed = 1))
+        controller = await self.open(emulator, RetryPolicy(overrides = {READ: FunctionPolicy(timeout = 0.3)}))
+        for offset in range(0, 2048, 128):
+            reply_read = await controller.request(message.request_ReadNVM(offset, 128), 'reply_ReadNVM')
+            self.assertEqual(reply_read.data, emulator.nvm[offset:offset + 128])
+        self.assertGreater(controller.retry_count, 0)
+
+    async def test_retry_policy(self):
+        emulator = ControllerEmulator()
+        controller = await self.open(emulator, RetryPolicy(overrides = {READ: FunctionPolicy(retries = 2, timeout = 0.1)}))
+        with mock.patch.dict(ControllerEmulator.HANDLERS, {READ: lambda emulator, args: None}):
+            self.assertEqual(await controller.request(message.request_ReadNVM(0, 128), 'reply_ReadNVM'), None)
+        self.assertEqual(controller.retry_count, 1)
+
+    async def test_details(self):
+        controller = await self.open(ControllerEmulator())
+        details = await controller.get_details()
+        self.assertEqual(details.home_id, "C0FFEE01")
+        self.assertEqual(details.chip, "ZW050x")
+        self.assertEqual(list(details.nodes), [1, 2])
+
+    async def test_list_nodes(self):
+        controller = await self.open(ControllerEmulator(nodes = {1: Node(basic = 0x02, generic = 0x02, specific = 0x07), 5: Node()}))
+        nodes = (await controller.list_nodes()).nodes
+        self.assertEqual([node.node_id for node in nodes], [1, 5])
+        self.assertEqual(nodes[0].class_basic, "Static Controller")
+
+    async def test_backup(self):
+        emulator = ControllerEmulator(nvm_size = 32768)
+        controller = await self.open(emulator)
+        path = self.path()
+        await controller.backup(path, 240)
+        with open(path, "rb") as f:
+            info, image = imagefile.load(f)
+        # Whole NVM by default
+        self.assertEqual((info.offset, info.size), (0, 32768))
+        self.assertEqual(image, emulator.nvm)
+
+    async def test_backup_short_read(self):
+        emulator = ControllerEmulator()
+        read_nvm = ControllerEmulator.HANDLERS[READ]
+        def _read_nvm(emulator, args):
+            if emulator.stats['read_nvm'] == 5:
+                emulator._response(message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER, bytes(emulator.nvm[:10]))
+                return
+            read_nvm(emulator, args)
+        controller = await self.open(emulator)
+        path = self.path()
+        with mock.patch.dict(ControllerEmulator.HANDLERS, {READ: _read_nvm}):
+            await controller.backup(path, region = (0, DataOperation.nvm_size))
+        with open(path, "rb") as f:
+            info, image = imagefile.load(f)
+        self.assertEqual(image, emulator.nvm[:DataOperation.nvm_size])
+        self.assertEqual(emulator.stats['read_nvm'], DataOperation.nvm_size // DataOperation.block_size + 1)
+
+    async def test_backup_failed(self):
+        emulator = ControllerEmulator()
+        controller = await self.open(emulator, RetryPolicy(retries = 1, overrides = {READ: FunctionPolicy(timeout = 0.1)}))
+        path = self.path()
+        with mock.patch.dict(ControllerEmulator.HANDLERS, {READ: lambda emulator, args: None}):
+            with self.assertRaises(RequestFailed):
+                await controller.backup(path)
+        self.assertFalse(os.path.exists(path))
+
+    async def test_restore(self):
+        source = ControllerEmulator(seed = 1)
+        path = self.path()
+        await (await self.open(source)).backup(path, 240)
+        emulator = ControllerEmulator(seed = 2)
+        controller = await self.open(emulator)
+        await controller.restore(path, 240)
+        self.assertEqual(emulator.nvm, source.nvm)
+        self.assertEqual(emulator.stats['set_default'], 1)
+
+    async def test_restore_larger_nvm(self):
+        source = ControllerEmulator(nvm_size = 32768)
+        path = self.path()
+        await (await self.open(source)).backup(path, 240)
+        emulator = ControllerEmulator()
+        controller = await self.open(emulator)
+        with self.assertRaises(RequestFailed):
+            await controller.restore(path, 240)
+        self.assertNotIn('set_default', emulator.stats)
+
+    async def test_cancel(self):
+        emulator = ControllerEmulator(faults = Faults(latency = 0.01))
+        controller = await self.open(emulator)
+        path = self.path()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(controller.backup(path), 0.3)
+        self.assertFalse(os.path.exists(path))
+        # The controller is still usable, the late response is not taken for the next one
+        reply_read = await controller.request(message.request_ReadNVM(256, 128), 'reply_ReadNVM')
+        self.assertEqual(reply_read.data, emulator.nvm[256:384])
+
+if __name__ == '__main__':
+    unittest.main()
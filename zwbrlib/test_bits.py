@@ -48,5 +48,32 @@ class TestIsBitSet(unittest.TestCase):
         self.assertFalse(bits.is_id_set(bit_field, 17))
         self.assertFalse(bits.is_id_set(bit_field, 18))
 
+class TestNodeBitmap(unittest.TestCase):
+
+    def test_bytes(self):
+        bit_field = bytes([0x05, 0x00, 0x80])
+        bitmap = bits.NodeBitmap.from_bytes(bit_field)
+        self.assertEqual(list(bitmap), [1, 3, 24])
+        self.assertEqual(bitmap.to_bytes(3), bit_field)
+        for bit_id in range(1, 30):
+            self.assertEqual(bit_id in bitmap, bits.is_id_set(bit_field, bit_id))
+
+    def test_ids(self):
+        bitmap = bits.NodeBitmap.from_ids([232, 1, 64, 9])
+        self.assertEqual(list(bitmap), [1, 9, 64, 232])
+        self.assertEqual(len(bitmap), 4)
+        self.assertEqual(len(bits.NodeBitmap()), 0)
+        self.assertFalse(bits.NodeBitmap())
+
+    def test_algebra(self):
+        first = bits.NodeBitmap.from_ids([1, 2, 3, 100])
+        second = bits.NodeBitmap.from_ids([3, 4, 100, 200])
+        self.assertEqual(list(first | second), [1, 2, 3, 4, 100, 200])
+        self.assertEqual(list(first & second), [3, 100])
+        self.assertEqual(list(first - second), [1, 2])
+        self.assertEqual(list(first ^ second), [1, 2, 4, 200])
+        self.assertEqual(first | second, second | first)
+        self.assertNotEqual(first, second)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,446 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from zwbrlib.backup import ZwBackup, BackupFailed
+from zwbrlib.bits import NodeBitmap
+import zwbrlib.imagefile as imagefile
+from zwbrlib.controller import Controller
+from zwbrlib.controllerdetails import ControllerDetails
+from zwbrlib.dataoperation import DataOperation
+import zwbrlib.message as message
+from zwbrlib.metrics import Metrics
+from zwbrlib.capture import CaptureWriter, ReplayTransport
+from zwbrlib.emulator import ControllerEmulator, Faults, Node
+from zwbrlib.fleet import backup_file_name
+from zwbrlib.nodelist import NodeList, NodeScan
+import zwbrlib.nvmlayout as nvmlayout
+from zwbrlib.progress import ProgressBar
+from zwbrlib.repository import BackupRepository
+from zwbrlib.resources import RESOURCES_DIR
+from zwbrlib.restore import ZwRestoration, RestorationFailed
+from zwbrlib.transfer import negotiate_block_size
+from zwbrlib.watch import NetworkWatch
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+class ControllerTestCase(unittest.TestCase):
+    """ Tests against an emulated controller """
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = self._directory.name
+        patches = [
+            mock.patch.dict(os.environ, {'ZWBR_CACHE_DIR': self.directory}),
+            mock.patch.object(ProgressBar, 'enabled', False),
+            ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def open(self, emulator, metrics = None):
+        emulator.start()
+        self.addCleanup(emulator.stop)
+        controller = Controller(emulator.device, metrics = metrics)
+        self.addCleanup(controller.close)
+        return controller
+
+    def backup(self, controller, block_size = None, region = None):
+        path = os.path.join(self.directory, "backup-%d" % len(os.listdir(self.directory)))
+        backup = ZwBackup(controller, path, block_size, ControllerDetails(controller), region = region)
+        backup.exec()
+        with open(path, "rb") as f:
+            info, image = imagefile.load(f)
+            return path, image
+
+class TestController(ControllerTestCase):
+
+    def test_details(self):
+        controller = self.open(ControllerEmulator())
+        details = ControllerDetails(controller)
+        self.assertEqual(details.home_id, "C0FFEE01")
+        self.assertEqual(details.chip, "ZW050x")
+        self.assertEqual(details.version, "Z-Wave 4.54")
+        self.assertEqual(details.manufacturer_id, "0x0086")
+        self.assertTrue(details.is_primary)
+
+    def test_nodes(self):
+        controller = self.open(ControllerEmulator())
+        details = ControllerDetails(controller)
+        nodes = NodeList(controller, details, False).nodes
+        self.assertEqual([node.node_id for node in nodes], [1, 2])
+        self.assertEqual(nodes[0].class_basic, "Static Controller")
+
+    def test_cache(self):
+        emulator = ControllerEmulator(nodes = {1: Node(), 2: Node(), 3: Node()})
+        controller = self.open(emulator)
+        versions = emulator.stats.get('get_version', 0)
+        NodeList(controller, ControllerDetails(controller), False)
+        details = ControllerDetails(controller)
+        nodes = NodeList(controller, details, False).nodes
+        self.assertEqual(details.home_id, "C0FFEE01")
+        self.assertEqual([node.node_id for node in nodes], [1, 2, 3])
+        self.assertEqual((emulator.stats['get_init_data'], emulator.stats['get_version'] - versions, emulator.stats['memory_get_id']), (2, 1, 2))
+        self.assertEqual(emulator.stats['get_node_protocol_info'], 3)
+
+        # Node added and removed: only the added node is queried, the details are queried again
+        emulator.nodes[4] = Node(generic = 0x11)
+        del emulator.nodes[2]
+        details = ControllerDetails(controller)
+        nodes = NodeList(controller, details, False).nodes
+        self.assertEqual([node.node_id for node in nodes], [1, 3, 4])
+        self.assertEqual(nodes[2].class_generic, "Multilevel Switch")
+        self.assertEqual((emulator.stats['get_version'] - versions, emulator.stats['memory_get_id']), (2, 3))
+        self.assertEqual(emulator.stats['get_node_protocol_info'], 4)
+
+        # Other controller with the same node list (stick swapped or reset)
+        emulator.home_id = 0xC0FFEE02
+        self.assertEqual(ControllerDetails(controller).home_id, "C0FFEE02")
+
+        # Other device with the same home id and node list (stick restored from a backup)
+        other = ControllerEmulator(nodes = dict(emulator.nodes), home_id = emulator.home_id)
+        ControllerDetails(self.open(other))
+        self.assertEqual(other.stats['get_capabilities'], 1)
+
+    def test_full_scan(self):
+        controller = self.open(ControllerEmulator(nodes = {1: Node(), 5: Node(), 232: Node()}, faults = Faults(nak = 0.05, drop = 0.05, seed = 2)))
+        scan = NodeScan(controller, list(range(1, 234)))
+        nodes = scan.exec()
+        self.assertEqual([node.node_id for node in nodes], [1, 5, 232])
+        self.assertEqual(len(scan.absent), 230)
+        self.assertEqual(scan.failed, [])
+
+    def test_unsolicited_subscriber(self):
+        emulator = ControllerEmulator(faults = Faults(unsolicited = 1, burst = 3, seed = 1))
+        controller = self.open(emulator)
+        subscriber = controller.subscribe(maxsize = 2)
+        ControllerDetails(controller)
+        self.assertEqual(subscriber.qsize(), 2)
+        self.assertEqual(controller.retry_count, 0)
+
+    def test_soft_reset(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        start = time.monotonic()
+        controller.soft_reset()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(emulator.stats['soft_reset'], 1)
+        self.assertIsNotNone(ControllerDetails(controller))
+
+    def test_nvm_size(self):
+        controller = self.open(ControllerEmulator(nvm_size = 32768))
+        self.assertEqual(nvmlayout.detect_nvm_size(controller, ControllerDetails(controller)), 32768)
+        self.assertEqual(nvmlayout.region_range('extended', 32768), (DataOperation.nvm_size, 32768 - DataOperation.nvm_size))
+        self.assertEqual(nvmlayout.region_range('all', None), (0, DataOperation.nvm_size))
+        self.assertRaises(ValueError, nvmlayout.region_range, 'extended', None)
+        self.assertRaises(ValueError, nvmlayout.region_range, 'extended', DataOperation.nvm_size)
+
+    def test_nvm_size_from_chip(self):
+        controller = self.open(ControllerEmulator())
+        details = ControllerDetails(controller)
+        details.funcid_supported = details.funcid_supported - NodeBitmap.from_ids(message.FUNC_ID_NVM_GET_ID)
+        self.assertEqual(nvmlayout.detect_nvm_size(controller, details), nvmlayout.NVM_SIZES["ZW050x"])
+
+    def test_nvm_size_too_large(self):
+        controller = self.open(ControllerEmulator())
+        details = ControllerDetails(controller)
+        # Capacity beyond the 3 bytes offsets of the NVM requests: size of the chip
+        with mock.patch.object(controller, 'request', return_value = mock.Mock(size = 1 << 25)):
+            self.assertEqual(nvmlayout.detect_nvm_size(controller, details), nvmlayout.NVM_SIZES["ZW050x"])
+
+    def test_negotiate_block_size(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        details = ControllerDetails(controller)
+        self.assertEqual(negotiate_block_size(controller, details), 240)
+        # The negotiation only reads the NVM
+        self.assertNotIn('write_nvm', emulator.stats)
+
+    def test_negotiate_block_size_ignored(self):
+        read_nvm = ControllerEmulator.HANDLERS[message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]]
+        def _read_nvm(emulator, args):
+            # Oversized reads not answered
+            if (args[3] << 8 | args[4]) <= 128:
+                read_nvm(emulator, args)
+        with mock.patch.dict(ControllerEmulator.HANDLERS, {message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]: _read_nvm}):
+            emulator = ControllerEmulator()
+            controller = self.open(emulator)
+            start = time.monotonic()
+            self.assertEqual(negotiate_block_size(controller, ControllerDetails(controller)), 128)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(emulator.stats['read_nvm'], 4)
+
+    def test_negotiate_block_size_limited(self):
+        controller = self.open(ControllerEmulator(max_transfer = 150))
+        details = ControllerDetails(controller)
+        self.assertEqual(negotiate_block_size(controller, details), 128)
+
+class TestCaptureReplay(ControllerTestCase):
+
+    def test_replay_backup(self):
+        # Same requests in both sessions: no cached details
+        patch = mock.patch.object(ControllerDetails, 'use_cache', False)
+        patch.start()
+        self.addCleanup(patch.stop)
+        emulator = ControllerEmulator(faults = Faults(nak = 0.05, unsolicited = 0.1, seed = 4))
+        capture_path = os.path.join(self.directory, "capture")
+        capture = CaptureWriter(capture_path)
+        emulator.start()
+        self.addCleanup(emulator.stop)
+        controller = Controller(emulator.device, capture = capture)
+        path, image = self.backup(controller, 240)
+        controller.close()
+        capture.close()
+
+        # Same session without the emulator
+        replay = None
+        def replay_factory(device):
+            nonlocal replay
+            replay = ReplayTransport(capture_path, Controller.read_timeout)
+            return replay
+        controller = Controller("replay", transport_factory = replay_factory)
+        self.addCleanup(controller.close)
+        path, replayed_image = self.backup(controller, 240)
+        self.assertEqual(replayed_image, image)
+        self.assertTrue(replay.finished())
+
+class TestBackupRestore(ControllerTestCase):
+
+    def test_backup(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        for block_size in (128, 240):
+            path, image = self.backup(controller, block_size)
+            self.assertEqual(image, emulator.nvm[:DataOperation.nvm_size])
+
+    def test_backup_faults(self):
+        emulator = ControllerEmulator(faults = Faults(nak = 0.1, can = 0.1, corrupt = 0.1, drop = 0.1, unsolicited = 0.2, seed = 1))
+        controller = self.open(emulator, Metrics())
+        path, image = self.backup(controller, 240)
+        self.assertEqual(image, emulator.nvm[:DataOperation.nvm_size])
+        self.assertGreater(controller.retry_count, 0)
+        metrics = controller.metrics
+        self.assertEqual(metrics.total('retries'), controller.retry_count)
+        self.assertGreater(metrics.total('nak'), 0)
+        self.assertLessEqual(metrics.total('nak'), emulator.stats['nak'])
+        self.assertGreater(metrics.total('can'), 0)
+        self.assertGreater(metrics.total('checksum_errors'), 0)
+        self.assertGreater(metrics.total('unsolicited_frames'), 0)
+        self.assertEqual(metrics.operations['backup']['bytes'], DataOperation.nvm_size)
+
+    def test_backup_stall(self):
+        emulator = ControllerEmulator()
+        read_nvm = ControllerEmulator.HANDLERS[message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]]
+        def _read_nvm(emulator, args):
+            # Single stall: the request is sent again and answered twice
+            if emulator.stats['read_nvm'] == 20:
+                time.sleep(0.5)
+            read_nvm(emulator, args)
+        with mock.patch.dict(ControllerEmulator.HANDLERS, {message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]: _read_nvm}):
+            controller = self.open(emulator, Metrics())
+            controller.retry_policy.observe(message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0], 0.01)
+            path, image = self.backup(controller, 128)
+        self.assertEqual(image, emulator.nvm[:DataOperation.nvm_size])
+        self.assertGreater(controller.retry_count, 0)
+
+    def restore(self, controller, path, differential = False):
+        with mock.patch.object(ZwRestoration, '_confirm_restore'), open(path, "rb") as f:
+            restore = ZwRestoration(controller, ControllerDetails(controller), f, differential, 240)
+            restore.exec()
+
+    def test_restore(self):
+        source = ControllerEmulator(seed = 1)
+        path, image = self.backup(self.open(source))
+        emulator = ControllerEmulator(seed = 2)
+        self.restore(self.open(emulator), path)
+        self.assertEqual(emulator.nvm[:DataOperation.nvm_size], image)
+        self.assertEqual(emulator.stats['set_default'], 1)
+
+    def test_backup_resume(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        path = os.path.join(self.directory, "backup")
+        read_block = ZwBackup._read_block
+        with mock.patch.object(ZwBackup, '_read_block', lambda backup, count: read_block(backup, count) if count < 30 else None):
+            self.assertRaises(BackupFailed, ZwBackup(controller, path, 128, ControllerDetails(controller)).exec)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + ".journal"))
+        reads = emulator.stats['read_nvm']
+        ZwBackup(controller, path, 128, ControllerDetails(controller), resume = True).exec()
+        self.assertEqual(emulator.stats['read_nvm'] - reads, 48 - 30)
+        self.assertFalse(os.path.exists(path + ".journal"))
+        with open(path, "rb") as f:
+            info, image = imagefile.load(f)
+        self.assertEqual(image, emulator.nvm[:DataOperation.nvm_size])
+
+    def test_backup_restore_all(self):
+        source = ControllerEmulator(seed = 1)
+        controller = self.open(source)
+        region = nvmlayout.nvm_region(controller, ControllerDetails(controller), 'all')
+        path, image = self.backup(controller, 240, region)
+        self.assertEqual(image, source.nvm)
+        emulator = ControllerEmulator(seed = 2)
+        self.restore(self.open(emulator), path)
+        self.assertEqual(emulator.nvm, source.nvm)
+
+    def test_backup_restore_extended(self):
+        source = ControllerEmulator(seed = 1)
+        controller = self.open(source)
+        region = nvmlayout.nvm_region(controller, ControllerDetails(controller), 'extended')
+        path, image = self.backup(controller, 240, region)
+        self.assertEqual(image, source.nvm[DataOperation.nvm_size:])
+        emulator = ControllerEmulator(seed = 2)
+        base = bytes(emulator.nvm[:DataOperation.nvm_size])
+        controller = self.open(emulator)
+        self.assertRaises(RestorationFailed, self.restore, controller, path)
+        self.restore(controller, path, True)
+        self.assertEqual(emulator.nvm[DataOperation.nvm_size:], image)
+        self.assertEqual(emulator.nvm[:DataOperation.nvm_size], base)
+        self.assertNotIn('set_default', emulator.stats)
+
+    def test_restore_larger_nvm(self):
+        source = ControllerEmulator(seed = 1)
+        controller = self.open(source)
+        path, image = self.backup(controller, 240, nvmlayout.nvm_region(controller, ControllerDetails(controller), 'all'))
+        emulator = ControllerEmulator(nvm_size = 8192, seed = 2)
+        self.assertRaises(RestorationFailed, self.restore, self.open(emulator), path)
+        self.assertNotIn('set_default', emulator.stats)
+        self.assertNotIn('write_nvm', emulator.stats)
+
+    def test_restore_resume(self):
+        path, image = self.backup(self.open(ControllerEmulator(seed = 1)), 128)
+        emulator = ControllerEmulator(seed = 2)
+        controller = self.open(emulator)
+        send_write = ZwRestoration._send_write
+        with mock.patch.object(ZwRestoration, '_send_write', lambda restore, request: restore._written_blocks < 20 and send_write(restore, request)):
+            self.assertRaises(RestorationFailed, self.restore, controller, path)
+        writes = emulator.stats['write_nvm']
+        with mock.patch.object(ZwRestoration, '_confirm_restore'), open(path, "rb") as f:
+            ZwRestoration(controller, ControllerDetails(controller), f, False, 240, True).exec()
+        self.assertEqual(emulator.nvm[:DataOperation.nvm_size], image)
+        self.assertEqual(emulator.stats['set_default'], 1)
+        self.assertEqual(emulator.stats['write_nvm'] - writes, 26 - 20)
+
+    def test_restore_resume_modified(self):
+        path, image = self.backup(self.open(ControllerEmulator(seed = 1)), 128)
+        emulator = ControllerEmulator(seed = 2)
+        controller = self.open(emulator)
+        send_write = ZwRestoration._send_write
+        with mock.patch.object(ZwRestoration, '_send_write', lambda restore, request: restore._written_blocks < 20 and send_write(restore, request)):
+            self.assertRaises(RestorationFailed, self.restore, controller, path)
+        # Block written before the interruption modified since
+        emulator.nvm[300] ^= 0xFF
+        with mock.patch.object(ZwRestoration, '_confirm_restore'), open(path, "rb") as f:
+            ZwRestoration(controller, ControllerDetails(controller), f, False, 240, True).exec()
+        self.assertEqual(emulator.nvm[:DataOperation.nvm_size], image)
+        self.assertEqual(emulator.stats['set_default'], 2)
+
+    def test_restore_invalid_block_size(self):
+        path, image = self.backup(self.open(ControllerEmulator(seed = 1)))
+        emulator = ControllerEmulator(seed = 2)
+        controller = self.open(emulator)
+        with mock.patch.object(ZwRestoration, '_confirm_restore'), open(path, "rb") as f:
+            restore = ZwRestoration(controller, ControllerDetails(controller), f, False, message.NVM_DATA_MAX_LENGTH + 2)
+            self.assertRaises(RestorationFailed, restore.exec)
+        # Failure before the reset of the controller
+        self.assertNotIn('set_default', emulator.stats)
+
+    def test_restore_differential(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        path, image = self.backup(controller, 240)
+        emulator.nvm[10] ^= 0xFF
+        emulator.nvm[5000] ^= 0xFF
+        writes = emulator.stats.get('write_nvm', 0)
+        self.restore(controller, path, True)
+        self.assertEqual(emulator.nvm[:DataOperation.nvm_size], image)
+        self.assertEqual(emulator.stats['write_nvm'] - writes, 2)
+        self.assertNotIn('set_default', emulator.stats)
+
+    def test_repository(self):
+        source = ControllerEmulator(seed = 1)
+        controller = self.open(source)
+        with BackupRepository(os.path.join(self.directory, "repository")) as repository:
+            backup = ZwBackup(controller, None, 240, ControllerDetails(controller), repository = repository)
+            backup.exec()
+            path = os.path.join(self.directory, "export.zwb")
+            repository.export(backup.snapshot_id, path)
+        emulator = ControllerEmulator(seed = 2)
+        self.restore(self.open(emulator), path)
+        self.assertEqual(emulator.nvm[:DataOperation.nvm_size], source.nvm[:DataOperation.nvm_size])
+
+class TestWatch(ControllerTestCase):
+
+    def test_watch(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        backups = list()
+        watch = NetworkWatch(controller, backups.append, 0, 0)
+        watch.exec(3)
+        self.assertEqual(len(backups), 1)
+        emulator.nodes[5] = Node()
+        watch.exec(2)
+        self.assertEqual(len(backups), 2)
+        # State of the last backup cached
+        self.assertEqual(NetworkWatch(controller, backups.append, 0, 0).last_state, watch.last_state)
+
+    def test_debounce(self):
+        emulator = ControllerEmulator()
+        controller = self.open(emulator)
+        backups = list()
+        watch = NetworkWatch(controller, backups.append, 0, 0.2)
+        self.assertFalse(watch.check())
+        emulator.nodes[5] = Node()
+        self.assertFalse(watch.check())
+        time.sleep(0.25)
+        self.assertTrue(watch.check())
+        self.assertFalse(watch.check())
+        self.assertEqual(len(backups), 1)
+
+class TestFleet(ControllerTestCase):
+
+    def zwbr(self, *args):
+        """ Runs zwbr.py, returns its exit code """
+        return subprocess.run([sys.executable, os.path.join(RESOURCES_DIR, 'zwbr.py')] + list(args), cwd = RESOURCES_DIR,
+                              stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, timeout = 60).returncode
+
+    def backups(self, directory):
+        images = list()
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "rb") as f:
+                images.append(imagefile.load(f)[1])
+        return images
+
+    def test_several_devices(self):
+        emulators = [ControllerEmulator(home_id = 0xC0FFEE01 + i, seed = i) for i in range(2)]
+        for emulator in emulators:
+            emulator.start()
+            self.addCleanup(emulator.stop)
+        dest = os.path.join(self.directory, "backups")
+        os.mkdir(dest)
+        self.assertEqual(self.zwbr("-b", dest, *[emulator.device for emulator in emulators]), 0)
+        self.assertEqual(self.backups(dest), [emulator.nvm for emulator in emulators])
+
+    def test_backup_file_name(self):
+        self.assertNotEqual(backup_file_name(self.directory, "C0FFEE01"), backup_file_name(self.directory, "C0FFEE01"))
+
+    def test_destination_directory(self):
+        emulator = ControllerEmulator()
+        emulator.start()
+        self.addCleanup(emulator.stop)
+        dest = os.path.join(self.directory, "backups")
+        os.mkdir(dest)
+        self.assertEqual(self.zwbr("-b", dest, "--region", "base", emulator.device), 0)
+        # Pattern matching a single device
+        self.assertEqual(self.zwbr("-b", dest, "--region", "base", "%s[%s]" % (emulator.device[:-1], emulator.device[-1])), 0)
+        self.assertEqual(self.backups(dest), [emulator.nvm[:DataOperation.nvm_size]] * 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+import zwbrlib.imagefile as imagefile
+from zwbrlib.dataoperation import DataOperation
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+IMAGE = bytes((i * 7) & 0xFF for i in range(DataOperation.nvm_size))
+
+class TestImageFile(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, 'backup.zwb')
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def write(self, block_size = 240, format = imagefile.FORMAT_VERSION):
+        with imagefile.ImageWriter(self.path, "C0FFEE01", "ZW050x", "Z-Wave 4.54", block_size, format) as writer:
+            for offset in range(0, len(IMAGE), block_size):
+                writer.write_block(IMAGE[offset:offset + block_size])
+            writer.commit()
+
+    def test_round_trip(self):
+        self.write()
+        with open(self.path, 'rb') as f:
+            info, image = imagefile.load(f)
+        self.assertEqual(image, IMAGE)
+        self.assertEqual((info.format, info.home_id, info.chip, info.version), (2, "C0FFEE01", "ZW050x", "Z-Wave 4.54"))
+        self.assertEqual((info.block_size, info.block_count), (240, 26))
+        self.assertEqual(os.listdir(self._directory.name), ['backup.zwb'])
+
+    def test_region(self):
+        image = bytes(range(256)) * 40
+        with imagefile.ImageWriter(self.path, "C0FFEE01", "ZW050x", "Z-Wave 4.54", 240, region = (6144, len(image))) as writer:
+            for offset in range(0, len(image), 240):
+                writer.write_block(image[offset:offset + 240])
+            writer.commit()
+        with open(self.path, "rb") as f:
+            info, data = imagefile.load(f)
+        self.assertEqual(info.format, imagefile.FORMAT_REGION)
+        self.assertEqual(info.region, (6144, len(image)))
+        self.assertEqual(data, image)
+        self.assertRaises(ValueError, imagefile.ImageWriter, self.path + "-1", format = 1, region = (0, len(image)))
+
+    def test_read_block(self):
+        self.write()
+        with open(self.path, 'rb') as f:
+            info = imagefile.read_info(f)
+            self.assertEqual(imagefile.read_block(f, info, 25), IMAGE[6000:])
+
+    def test_format_1(self):
+        self.write(format = 1)
+        self.assertEqual(os.path.getsize(self.path), DataOperation.nvm_size)
+        with open(self.path, 'rb') as f:
+            info, image = imagefile.load(f)
+        self.assertEqual(info.format, 1)
+        self.assertEqual(image, IMAGE)
+
+    def test_invalid_block(self):
+        self.write()
+        with open(self.path, 'r+b') as f:
+            info = imagefile.read_info(f)
+            f.seek(info.data_offset + 3 * 240 + 5)
+            f.write(b'\xFF\x00')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(imagefile.verify(f), [3])
+            self.assertRaises(imagefile.InvalidImage, imagefile.load, f)
+
+    def test_invalid_header(self):
+        self.write()
+        with open(self.path, 'r+b') as f:
+            f.seek(20)
+            f.write(b'X')
+        with open(self.path, 'rb') as f:
+            self.assertRaises(imagefile.InvalidImage, imagefile.read_info, f)
+
+    def test_abort(self):
+        with self.assertRaises(RuntimeError):
+            with imagefile.ImageWriter(self.path) as writer:
+                writer.write_block(IMAGE[:128])
+                raise RuntimeError
+        self.assertEqual(os.listdir(self._directory.name), [])
+
+    def test_existing_file(self):
+        self.write()
+        self.assertRaises(FileExistsError, imagefile.ImageWriter, self.path)
+
+    def test_created_during_write(self):
+        with imagefile.ImageWriter(self.path, block_size = 6144) as writer:
+            writer.write_block(IMAGE)
+            # Concurrent backup to the same destination
+            with open(self.path, 'wb') as f:
+                f.write(b'other')
+            self.assertRaises(FileExistsError, writer.commit)
+        self.assertEqual(os.listdir(self._directory.name), ['backup.zwb'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'other')
+
+    def test_no_commit(self):
+        with imagefile.ImageWriter(self.path) as writer:
+            writer.write_block(IMAGE[:128])
+        self.assertEqual(os.listdir(self._directory.name), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import tempfile
+import unittest
+
+import zwbrlib.manufacturers as manufacturers
+from zwbrlib.resources import MANUFACTURERS_FILE
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+class TestManufacturers(unittest.TestCase):
+
+    def tearDown(self):
+        manufacturers.use_file(MANUFACTURERS_FILE)
+
+    def test_lookup(self):
+        self.assertEqual(manufacturers.lookup(0x0086), "AEON Labs")
+        self.assertEqual(manufacturers.lookup("0x0086"), "AEON Labs")
+        self.assertEqual(manufacturers.lookup(0xFFFE), manufacturers.UNKNOWN)
+        self.assertEqual(manufacturers.lookup("invalid"), manufacturers.UNKNOWN)
+
+    def test_lookup_many(self):
+        self.assertEqual(manufacturers.lookup_many([0x0000, "0x0002"]), {0x0000: "Z-Wave", "0x0002": "Danfoss"})
+
+    def test_use_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'manufacturers.csv')
+            with open(path, 'w') as f:
+                f.write("ID,Manufacturer\n0x0086,Aeotec\n0x1234,New manufacturer\n")
+            manufacturers.use_file(path)
+            self.assertEqual(manufacturers.lookup(0x0086), "Aeotec")
+            self.assertEqual(manufacturers.lookup(0x1234), "New manufacturer")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import random
+import unittest
+
+import zwbrlib.message as message
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+def checksum(length, payload):
+    """ Reference checksum, byte by byte """
+    value = 0xFF ^ length
+    for i in range(0, length - 1):
+        value ^= payload[i]
+    return value
+
+class TestMessage(unittest.TestCase):
+
+    def test_checksum(self):
+        rand = random.Random(1)
+        for size in range(0, message.FRAME_MAX_LENGTH):
+            payload = bytes(rand.getrandbits(8) for i in range(size)) + b'\xAA'
+            self.assertEqual(message.compute_checksum(size + 1, payload), checksum(size + 1, payload))
+            self.assertEqual(message.compute_checksum(size + 1, memoryview(payload)), checksum(size + 1, payload))
+
+    def test_constant_requests(self):
+        self.assertIs(message.request_GetVersion(), message.request_GetVersion())
+        self.assertEqual(message.request_GetVersion().frame, bytes([0x01, 0x03, 0x00, 0x15, 0xE9]))
+        self.assertEqual(message.request_SetDefault().frame, bytes([0x01, 0x04, 0x00, 0x42, 0x12, 0xAB]))
+
+    def test_nvm_requests(self):
+        self.assertEqual(bytes(message.request_ReadNVM(0x1234, 240).frame),
+                         bytes([0x01, 0x08, 0x00, 0x2A, 0x00, 0x12, 0x34, 0x00, 0xF0, 0x0B]))
+        frame = message.request_WriteNVM(0x010203, b'\x10\x20')
+        self.assertEqual(bytes(frame.frame), bytes([0x01, 0x0A, 0x00, 0x2B, 0x01, 0x02, 0x03, 0x00, 0x02, 0x10, 0x20, 0xEC]))
+        self.assertRaises(message.PayloadTooLargeError, message.request_WriteNVM, 0, bytes(message.NVM_DATA_MAX_LENGTH + 1))
+        self.assertRaises(ValueError, message.request_ReadNVM, message.NVM_OFFSET_LIMIT, 16)
+        self.assertRaises(ValueError, message.request_WriteNVM, message.NVM_OFFSET_LIMIT + 128, bytes(16))
+
+    def test_replies(self):
+        frame = message.Frame(bytes([0x01, 0x08, 0x01, 0x20, 0xC0, 0xFF, 0xEE, 0x01, 0x01, 0x00]))
+        reply = frame.reply_MemoryGetId()
+        self.assertEqual((reply.home_id, reply.node_id), ("C0FFEE01", 1))
+        self.assertEqual(frame.reply_ReadNVM(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+import unittest
+
+import zwbrlib.metrics as metrics
+from zwbrlib.metrics import Metrics, Histogram
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counters(self):
+        collected = Metrics()
+        collected.count('requests', 0x2A)
+        collected.count('requests', 0x2A)
+        collected.count('requests', 0x02)
+        collected.count('bytes_in', value = 100)
+        self.assertEqual(collected.get('requests', 0x2A), 2)
+        self.assertEqual(collected.total('requests'), 3)
+        self.assertEqual(collected.get('bytes_in'), 100)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in (0.001, 0.02, 0.02, 20):
+            histogram.observe(value)
+        buckets = histogram.to_dict()['buckets']
+        self.assertEqual(buckets['0.005'], 1)
+        self.assertEqual(buckets['0.025'], 3)
+        self.assertEqual(buckets['10'], 3)
+        self.assertEqual(buckets['+Inf'], 4)
+        self.assertEqual(histogram.count, 4)
+
+    def test_prometheus(self):
+        first = Metrics(device = "/dev/ttyACM0")
+        second = Metrics(device = "/dev/ttyACM1")
+        for collected in (first, second):
+            collected.count('requests', 0x2A)
+            collected.observe_latency(0x2A, 0.02)
+            collected.operation('backup', 6144, 26, 2)
+        text = metrics.to_prometheus([first, second])
+        self.assertEqual(text.count("# TYPE zwbr_requests_total counter"), 1)
+        self.assertEqual(text.count("# TYPE zwbr_request_duration_seconds histogram"), 1)
+        self.assertIn('zwbr_requests_total{device="/dev/ttyACM1",func="0x2a"} 1', text)
+        self.assertIn('zwbr_request_duration_seconds_bucket{device="/dev/ttyACM0",func="0x2a",le="0.025"} 1', text)
+        self.assertIn('zwbr_operation_bytes_per_second{device="/dev/ttyACM0",operation="backup"} 3072.0', text)
+
+    def test_write_json(self):
+        collected = Metrics(device = "COM4")
+        collected.count('nak', 0x2B)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            metrics.write(path, [collected])
+            with open(path) as f:
+                content = json.load(f)
+        self.assertEqual(content[0]['counters']['nak'], {'0x2b': 1})
+        self.assertEqual(content[0]['labels'], {'device': "COM4"})
+
+    def test_disabled(self):
+        metrics.no_metrics.count('requests', 0x2A)
+        self.assertEqual(metrics.no_metrics.total('requests'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
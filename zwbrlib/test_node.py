@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import zwbrlib.node as node
+from zwbrlib.resources import DEVICE_CLASSES_FILE as XML_PATH
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+class TestDeviceClassIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self._directory.name, 'index')
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_lookups(self):
+        index = node.load_index(XML_PATH, self.cache_path)
+        self.assertEqual(index.find_class_basic(0x02), "Static Controller")
+        self.assertEqual(index.find_class_generic(0x01), "Remote Controller")
+        self.assertEqual(index.find_class_specific(0x02, 0x07), "Gateway")
+        self.assertEqual(index.find_class_specific(0x01, 0x07), "Unknown")
+        self.assertEqual(index.find_class_basic(0xFE), "Unknown")
+
+    def test_precompiled(self):
+        built = node.load_index(XML_PATH, self.cache_path)
+        self.assertTrue(os.path.exists(self.cache_path))
+        loaded = node.load_index(XML_PATH, self.cache_path)
+        self.assertEqual((loaded.basic, loaded.generic, loaded.specific), (built.basic, built.generic, built.specific))
+
+    def test_invalidated(self):
+        xml_path = os.path.join(self._directory.name, 'classes.xml')
+        shutil.copy(XML_PATH, xml_path)
+        node.load_index(xml_path, self.cache_path)
+        with open(xml_path, 'w') as f:
+            f.write('<DeviceClasses xmlns="https://github.com/OpenZWave/open-zwave"><Basic key="0x02" label="Changed"/></DeviceClasses>')
+        index = node.load_index(xml_path, self.cache_path)
+        self.assertEqual(index.find_class_basic(0x02), "Changed")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+import zwbrlib.imagefile as imagefile
+from zwbrlib.dataoperation import DataOperation
+from zwbrlib.repository import BackupRepository, SnapshotNotFound, BLOCK_SIZE
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+IMAGE = bytes((i * 7) & 0xFF for i in range(DataOperation.nvm_size))
+
+class TestRepository(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.repository = BackupRepository(self._directory.name)
+
+    def tearDown(self):
+        self.repository.close()
+        self._directory.cleanup()
+
+    def count_blocks(self):
+        return self.repository._db.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+
+    def test_deduplication(self):
+        first = self.repository.add_snapshot(IMAGE, "C0FFEE01", "ZW050x", "Z-Wave 4.54", created = 100)
+        blocks = self.count_blocks()
+        second = self.repository.add_snapshot(IMAGE, "C0FFEE01", created = 200)
+        self.assertEqual(self.count_blocks(), blocks)
+        changed = bytearray(IMAGE)
+        changed[1000] ^= 0xFF
+        third = self.repository.add_snapshot(changed, "C0FFEE01", created = 300)
+        self.assertEqual(self.count_blocks(), blocks + 1)
+        self.assertEqual(self.repository.image(second), IMAGE)
+        self.assertEqual(self.repository.image(third), changed)
+        self.assertEqual(self.repository.diff(first, second), [])
+        self.assertEqual(self.repository.diff(second, third), [(1000 // BLOCK_SIZE, 1000 // BLOCK_SIZE * BLOCK_SIZE)])
+
+    def test_snapshots(self):
+        self.repository.add_snapshot(IMAGE, "C0FFEE02", created = 300)
+        second = self.repository.add_snapshot(IMAGE, "C0FFEE01", created = 200)
+        first = self.repository.add_snapshot(IMAGE, "C0FFEE01", created = 100)
+        self.assertEqual([snapshot.id for snapshot in self.repository.snapshots("C0FFEE01")], [first, second])
+        self.assertEqual(len(self.repository.snapshots()), 3)
+        self.assertEqual(self.repository.latest("C0FFEE01").id, second)
+        self.assertEqual(self.repository.latest("C0FFEE03"), None)
+        self.assertRaises(SnapshotNotFound, self.repository.snapshot, 42)
+
+    def test_export(self):
+        snapshot_id = self.repository.add_snapshot(IMAGE, "C0FFEE01", "ZW050x", "Z-Wave 4.54")
+        path = os.path.join(self._directory.name, "export.zwb")
+        self.repository.export(snapshot_id, path)
+        with open(path, "rb") as f:
+            info, image = imagefile.load(f)
+        self.assertEqual(image, IMAGE)
+        self.assertEqual((info.home_id, info.chip, info.version), ("C0FFEE01", "ZW050x", "Z-Wave 4.54"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+import zwbrlib.message as message
+from zwbrlib.retry import RetryPolicy, FunctionPolicy, parse_function_timeout
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+READ = message.FUNC_ID_NVM_EXT_READ_LONG_BUFFER[0]
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_initial_timeout(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.timeout(READ), RetryPolicy.initial_timeout)
+        self.assertEqual(policy.attempts(READ), RetryPolicy.retries)
+
+    def test_estimated_timeout(self):
+        policy = RetryPolicy()
+        policy.observe(READ, 0.1)
+        # SRTT + 4 * RTTVAR = 0.1 + 4 * 0.05
+        self.assertAlmostEqual(policy.timeout(READ), 0.3)
+        for i in range(50):
+            policy.observe(READ, 0.01)
+        self.assertAlmostEqual(policy.timeout(READ), RetryPolicy.min_timeout)
+
+    def test_timeout_backoff(self):
+        policy = RetryPolicy(max_timeout = 3)
+        policy.timed_out(READ)
+        self.assertEqual(policy.timeout(READ), 2)
+        policy.timed_out(READ)
+        self.assertEqual(policy.timeout(READ), 3)
+
+    def test_overrides(self):
+        policy = RetryPolicy(overrides = {READ: FunctionPolicy(retries = 3, timeout = 0.5)})
+        policy.observe(READ, 2)
+        self.assertEqual(policy.timeout(READ), 0.5)
+        self.assertEqual(policy.attempts(READ), 3)
+        self.assertEqual(policy.timeout(message.FUNC_ID_ZW_SET_DEFAULT[0]), 10)
+
+    def test_no_retry(self):
+        policy = RetryPolicy(retries = 0)
+        self.assertEqual(policy.attempts(READ), 1)
+
+    def test_merged_overrides(self):
+        set_default = message.FUNC_ID_ZW_SET_DEFAULT[0]
+        policy = RetryPolicy(overrides = {set_default: FunctionPolicy(timeout = 30)})
+        self.assertEqual(policy.timeout(set_default), 30)
+        self.assertEqual(policy.attempts(set_default), 3)
+
+    def test_budget(self):
+        policy = RetryPolicy(retries = 2, max_timeout = 1)
+        attempts, duration = policy.budget(READ)
+        self.assertEqual(attempts, 2)
+        self.assertAlmostEqual(duration, 4 + policy.backoff(0) + policy.backoff(1))
+
+    def test_nak_backoff(self):
+        policy = RetryPolicy()
+        self.assertLess(policy.backoff(0), policy.backoff(1))
+        self.assertEqual(policy.backoff(30), RetryPolicy.backoff_max)
+
+    def test_parse_function_timeout(self):
+        func_id, override = parse_function_timeout("0x42=7.5")
+        self.assertEqual(func_id, 0x42)
+        self.assertEqual(override.timeout, 7.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from zwbrlib.resources import RESOURCES_DIR
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+# Budget of the imports of 'zwbr.py -h' (microseconds)
+IMPORT_BUDGET = 500000
+
+def imported_modules(*args):
+    """ Returns the modules imported by python -X importtime and their self time """
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + list(args), cwd = RESOURCES_DIR,
+                            stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
+    modules = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(self_time)
+    return modules
+
+class TestStartup(unittest.TestCase):
+
+    def test_help(self):
+        modules = imported_modules(os.path.join(RESOURCES_DIR, 'zwbr.py'), '-h')
+        for module in ('serial', 'xml.etree.ElementTree', 'csv', 'zwbrlib.controller', 'concurrent.futures'):
+            self.assertNotIn(module, modules)
+        self.assertLess(sum(modules.values()), IMPORT_BUDGET)
+
+    def test_backup_path(self):
+        modules = imported_modules('-c', 'import zwbrlib.controllerdetails, zwbrlib.backup, zwbrlib.transfer')
+        self.assertIn('serial', modules)
+        for module in ('xml.etree.ElementTree', 'csv', 'concurrent.futures'):
+            self.assertNotIn(module, modules)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+import zwbrlib.message as message
+from zwbrlib.transport import FrameParser as FrameParser
+
+# To run tests: python3 -m unittest discover -s zwbrlib
+
+def data_frame(payload):
+    return message._data(payload)
+
+class TestFrameParser(unittest.TestCase):
+
+    def parse(self, parser, data):
+        parser.feed(data)
+        return [frame.frame for frame in parser.frames()]
+
+    def test_link_frames(self):
+        parser = FrameParser()
+        self.assertEqual(self.parse(parser, message.FRAME_ACK + message.FRAME_NAK + message.FRAME_CAN),
+                         [message.FRAME_ACK, message.FRAME_NAK, message.FRAME_CAN])
+
+    def test_data_frames(self):
+        parser = FrameParser()
+        first = data_frame(bytes([0x01, 0x15, 0x41, 0x42]))
+        second = data_frame(bytes([0x01, 0x20, 0x01, 0x02, 0x03, 0x04, 0x01]))
+        self.assertEqual(self.parse(parser, message.FRAME_ACK + first + second), [message.FRAME_ACK, first, second])
+        self.assertEqual(parser.pending(), 0)
+
+    def test_split_frame(self):
+        parser = FrameParser()
+        frame = data_frame(bytes([0x01, 0x2A]) + bytes(range(100)))
+        self.assertEqual(self.parse(parser, frame[0:1]), [])
+        self.assertEqual(self.parse(parser, frame[1:50]), [])
+        self.assertEqual(self.parse(parser, frame[50:]), [frame])
+
+    def test_checksum_resync(self):
+        parser = FrameParser()
+        invalid = bytearray(data_frame(bytes([0x01, 0x15, 0x41, 0x42])))
+        invalid[-1] ^= 0xFF
+        valid = data_frame(bytes([0x01, 0x20, 0x01]))
+        self.assertEqual(self.parse(parser, bytes(invalid) + valid), [message.FRAME_DISCARDED, valid])
+
+    def test_drop_incomplete(self):
+        parser = FrameParser()
+        frame = data_frame(bytes([0x01, 0x15, 0x41, 0x42]))
+        self.assertEqual(self.parse(parser, frame[:-2]), [])
+        self.assertTrue(parser.drop_incomplete())
+        self.assertEqual(self.parse(parser, frame), [frame])
+
+    def test_buffer_reuse(self):
+        parser = FrameParser(size = 512)
+        frame = data_frame(bytes([0x01, 0x2A]) + bytes(200))
+        for i in range(20):
+            self.assertEqual(self.parse(parser, frame + message.FRAME_ACK), [frame, message.FRAME_ACK])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import logging
+
+from zwbrlib.controller import Controller as Controller
+from zwbrlib.controllerdetails import ControllerDetails as ControllerDetails
+from zwbrlib.dataoperation import DataOperation as DtOp
+import zwbrlib.cache as cache
+import zwbrlib.message as message
+
+# Transfer sizes tried, the largest first
+CANDIDATE_BLOCK_SIZES = (240, 192, 160, 128)
+
+CACHE_NAME = 'transfer'
+
+# Timeout of a probe (seconds): a controller may not answer an oversized read at all
+PROBE_TIMEOUT = 0.5
+
+def cache_key(controller_details: ControllerDetails):
+    """ The transfer size depends on the controller model and firmware """
+    return "%s/%s/%s/%s/%s" % (controller_details.manufacturer_id, controller_details.product_type,
+                               controller_details.product_id, controller_details.chip, controller_details.version)
+
+def negotiate_block_size(controller: Controller, controller_details: ControllerDetails):
+    """ Returns the largest NVM read size accepted by the controller (one short attempt per size).
+    The size found is cached for the controller model and firmware. Only reads are probed:
+    a restoration uses the default size unless a size is given. """
+    key = cache_key(controller_details)
+    sizes = cache.load(CACHE_NAME)
+    if key in sizes:
+        logging.debug("Transfer size %d (cached)" % sizes[key])
+        return sizes[key]
+
+    block_size = DtOp.block_size
+    for size in CANDIDATE_BLOCK_SIZES:
+        if size <= message.NVM_DATA_MAX_LENGTH and _probe(controller, size):
+            block_size = size
+            break
+
+    logging.debug("Transfer size %d" % block_size)
+    sizes[key] = block_size
+    cache.save(CACHE_NAME, sizes)
+    return block_size
+
+def _probe(controller: Controller, size):
+    """ Reads the first bytes of the NVM; the size is accepted when the whole read is returned.
+    Nothing is written: a backup must leave the NVM untouched, a restore is not confirmed yet. """
+    reply_read = controller.request(message.request_ReadNVM(0, size), 'reply_ReadNVM', retries = 1, timeout = PROBE_TIMEOUT)
+    return reply_read != None and len(reply_read.data) == size
@@ -0,0 +1,164 @@
+import logging
+
+import serial
+
+import zwbrlib.message as message
+from zwbrlib.message import Frame as Frame
+from zwbrlib.metrics import no_metrics as no_metrics
+
+# Directions of the captured data (see zwbrlib.capture)
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+# Link frames by byte (immutable, the same frames are yielded)
+LINK_FRAMES = {message.FRAME_ACK[0]: message.ack, message.FRAME_NAK[0]: message.nak, message.FRAME_CAN[0]: message.can}
+
+class FrameParser:
+    """ Splits the received bytes into frames.
+    The bytes are read into a reusable buffer and the frames are sliced out of it;
+    each complete frame is copied once, when handed over as a Frame."""
+
+    def __init__(self, size = 4096, metrics = no_metrics):
+        self._metrics = metrics
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def pending(self):
+        """ Number of bytes not parsed yet """
+        return self._end - self._start
+
+    def free_space(self) -> memoryview:
+        """ Returns the free part of the buffer; bytes read into it must be committed with filled() """
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer) or self._start > len(self._buffer) // 2:
+            # Move the pending bytes to the beginning of the buffer
+            pending = self._end - self._start
+            self._buffer[0:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        return self._view[self._end:]
+
+    def filled(self, count):
+        self._end += count
+
+    def feed(self, data: bytes):
+        """ Adds received bytes """
+        while len(data) > 0:
+            free = self.free_space()
+            count = min(len(free), len(data))
+            free[0:count] = data[0:count]
+            self.filled(count)
+            data = data[count:]
+
+    def frames(self):
+        """ Yields the complete frames; message.discarded for each invalid frame """
+        buffer = self._buffer
+        view = self._view
+        while self._start < self._end:
+            start = self._start
+            type = buffer[start]
+            if type in LINK_FRAMES:
+                self._start = start + 1
+                yield LINK_FRAMES[type]
+                continue
+
+            if type != message.FRAME_SOF[0]:
+                logging.debug("Discard unexpected byte 0x%02x" % type)
+                self._resync(start)
+                yield message.discarded
+                continue
+
+            if self._end - start < 2:
+                return
+            length = buffer[start + 1]
+            if length < 3 or length > message.FRAME_MAX_LENGTH:
+                logging.debug("Discard invalid frame (length %d)" % length)
+                self._resync(start)
+                yield message.discarded
+                continue
+            if self._end - start < length + 2:
+                return
+
+            payload = view[start + 2:start + 2 + length]
+            if payload[length - 1] != message.compute_checksum(length, payload):
+                logging.debug("Discard invalid frame (checksum)")
+                self._metrics.count('checksum_errors')
+                end = start + 2 + length
+                if end == self._end or buffer[end] == message.FRAME_SOF[0] or buffer[end] in LINK_FRAMES:
+                    # Length looks valid, skip the whole frame
+                    self._start = end
+                else:
+                    self._resync(start)
+                yield message.discarded
+                continue
+
+            self._start = start + 2 + length
+            yield Frame(bytes(view[start:self._start]))
+
+    def drop_incomplete(self):
+        """ Drops an incomplete frame whose remaining bytes are not coming """
+        if self._start < self._end:
+            logging.debug("Discard incomplete frame")
+            self._start = self._end
+            return True
+        return False
+
+    def _resync(self, start):
+        """ Skips the bytes up to the next start of frame; the pending bytes are kept """
+        next_sof = self._buffer.find(message.FRAME_SOF, start + 1, self._end)
+        self._start = self._end if next_sof < 0 else next_sof
+
+class SerialTransport:
+    """ Serial port access: buffered reads and coalesced writes """
+
+    def __init__(self, device, read_timeout, metrics = no_metrics, capture = None):
+        self._metrics = metrics
+        # Raw capture of the exchanged bytes (zwbrlib.capture.CaptureWriter)
+        self._capture = capture
+        self._device = serial.Serial(port=device, baudrate=115200)
+        self._device.timeout = read_timeout
+        # Drop the data received before the opening
+        self._device.reset_input_buffer()
+        self._parser = FrameParser(metrics = metrics)
+        logging.debug(self._device)
+
+    def __str__(self):
+        return str(self._device)
+
+    def is_open(self):
+        return self._device.isOpen()
+
+    def close(self):
+        self._device.close()
+
+    def read_frames(self):
+        """ Waits for data (up to the read timeout) and returns the complete frames received.
+        An incomplete frame is dropped when no data is received during the timeout. """
+        free = self._parser.free_space()
+        count = self._device.readinto(free[0:1])
+        if count == 0:
+            if self._parser.drop_incomplete():
+                return [message.discarded]
+            return []
+        waiting = self._device.in_waiting
+        if waiting > 0:
+            count += self._device.readinto(free[1:1 + min(waiting, len(free) - 1)])
+        if self._capture is not None:
+            self._capture.record(DIRECTION_IN, bytes(free[0:count]))
+        self._parser.filled(count)
+        self._metrics.count('bytes_in', value = count)
+        return list(self._parser.frames())
+
+    def write(self, *frames: Frame):
+        """ Writes the frames in a single write """
+        if len(frames) == 1:
+            data = frames[0].frame
+        else:
+            data = b''.join(frame.frame for frame in frames)
+        self._metrics.count('bytes_out', value = len(data))
+        if self._capture is not None:
+            self._capture.record(DIRECTION_OUT, data)
+        return self._device.write(data)
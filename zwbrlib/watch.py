@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+from zwbrlib.controller import Controller as Controller
+from zwbrlib.bits import NodeBitmap as NodeBitmap
+import zwbrlib.cache as cache
+import zwbrlib.message as message
+
+CACHE_NAME = 'watch'
+
+class NetworkWatch:
+    """ Watch of the network of a controller: the node list (init data) and the home id are
+    polled, a backup is done only when they change and stay stable for the debounce delay
+    (an inclusion or exclusion may be followed by others).
+    The state of the last backup is cached: a restart does not backup again an unchanged network. """
+
+    # Delay between the polls and delay of stability before a backup (seconds)
+    interval = 60
+    debounce = 30
+
+    def __init__(self, controller: Controller, backup, interval = None, debounce = None):
+        """ backup is called with the controller; it returns False or raises an exception on failure """
+        self._controller = controller
+        self._backup = backup
+        self._interval = interval if interval != None else NetworkWatch.interval
+        self._debounce = debounce if debounce != None else NetworkWatch.debounce
+        self._key = controller.device
+        self._stop = threading.Event()
+        self.backup_count = 0
+        self.last_state = cache.load(CACHE_NAME).get(self._key)
+        self._pending_state = None
+        self._pending_since = None
+
+    def stop(self):
+        self._stop.set()
+
+    def poll_state(self):
+        """ Node list and home id, or None if the controller does not reply """
+        reply_init_data = self._controller.request(message.request_SerialApiGetInitData(), 'reply_SerialApiGetInitData')
+        if reply_init_data == None:
+            return None
+        reply_ids = self._controller.request(message.request_MemoryGetId(), 'reply_MemoryGetId')
+        if reply_ids == None:
+            return None
+        return {'home_id': reply_ids.home_id, 'nodes': bytes(reply_init_data.nodes).hex()}
+
+    def exec(self, polls = None):
+        """ Watches until stop() is called, or for a count of polls """
+        logging.info("--- watch -------")
+        count = 0
+        while not self._stop.is_set() and (polls == None or count < polls):
+            self.check()
+            count += 1
+            self._stop.wait(self._interval)
+
+    def check(self):
+        """ One poll; returns True if a backup was done """
+        state = self.poll_state()
+        if state == None:
+            logging.warning("Watch: no reply of the controller")
+            return False
+        if state == self.last_state:
+            self._pending_state = None
+            return False
+        now = time.monotonic()
+        if state != self._pending_state:
+            self._log_change(state)
+            self._pending_state = state
+            self._pending_since = now
+        if now - self._pending_since < self._debounce:
+            return False
+
+        try:
+            if self._backup(self._controller) == False:
+                return False
+        except Exception:
+            logging.exception("Backup failed")
+            return False
+        self.backup_count += 1
+        self.last_state = state
+        self._pending_state = None
+        cached = cache.load(CACHE_NAME)
+        cached[self._key] = state
+        cache.save(CACHE_NAME, cached)
+        return True
+
+    def _log_change(self, state):
+        nodes = NodeBitmap.from_bytes(bytes.fromhex(state['nodes']))
+        if self.last_state == None:
+            logging.info("Network of home id %s: %d node(s)" % (state['home_id'], len(nodes)))
+            return
+        last_nodes = NodeBitmap.from_bytes(bytes.fromhex(self.last_state['nodes']))
+        logging.info("Network change detected: home id %s, node(s) added %s, removed %s" % (
+            state['home_id'], list(nodes - last_nodes), list(last_nodes - nodes)))